@@ -1,10 +1,14 @@
+import threading
+
 import llvmlite.llvmpy.core as ll_core
 
-def create_execution_engine():
+from numpile.cache import FunctionCache, ObjectCache, default_cache_dir, default_cache_limits
+
+def create_target_machine(**options):
     """
-    Create an ExecutionEngine suitable for JIT code generation on
-    the host CPU.  The engine is reusable for an arbitrary number of
-    modules.
+    Create a TargetMachine for the host. Keyword options are passed on to
+    ``Target.create_target_machine``, e.g. ``reloc='pic'`` for shared
+    libraries.
     """
     import llvmlite.binding as llvm
 
@@ -12,10 +16,20 @@ def create_execution_engine():
     llvm.initialize_native_target()
     llvm.initialize_native_asmprinter()  # yes, even this one
 
+    target = llvm.Target.from_default_triple()
+    return target.create_target_machine(**options)
+
+
+def create_execution_engine(**options):
+    """
+    Create an ExecutionEngine suitable for JIT code generation on
+    the host CPU.  The engine is reusable for an arbitrary number of
+    modules. Keyword options go to ``create_target_machine``.
+    """
+    import llvmlite.binding as llvm
 
     # Create a target machine representing the host
-    target = llvm.Target.from_default_triple()
-    target_machine = target.create_target_machine()
+    target_machine = create_target_machine(**options)
     # And an execution engine with an empty backing module
     backing_mod = llvm.parse_assembly("")
     engine = llvm.create_mcjit_compiler(backing_mod, target_machine)
@@ -23,4 +37,72 @@ def create_execution_engine():
 
 module = ll_core.Module('numpile.module')
 engine, target = create_execution_engine()
-function_cache = {}
\ No newline at end of file
+# MCJIT is not thread safe; anything touching the engine must hold this.
+engine_lock = threading.RLock()
+object_cache = ObjectCache(default_cache_dir())
+object_cache.install(engine)
+
+
+_host_engine = None
+
+
+def host_engine():
+    """
+    An engine like ``engine`` whose code is tuned for, and only runs on,
+    this exact CPU model and its features. Created on first use.
+    """
+    import llvmlite.binding as llvm
+
+    global _host_engine
+    with engine_lock:
+        if _host_engine is None:
+            _host_engine = create_execution_engine(cpu=llvm.get_host_cpu_name(),
+                                                   features=llvm.get_host_cpu_features().flatten())
+            object_cache.install(_host_engine[0])
+        return _host_engine
+
+
+def release_module(mod):
+    with engine_lock:
+        getattr(mod, 'engine', engine).remove_module(mod)
+
+
+function_cache = FunctionCache(release_module, *default_cache_limits())
+
+
+def set_cache_dir(path):
+    """
+    Persist compiled object code under ``path``. Passing None disables the
+    on-disk cache; the in-memory ``function_cache`` is unaffected.
+    """
+    object_cache.path = path
+
+
+def set_cache_limits(max_entries=None, max_bytes=None):
+    """
+    Bound the specializations kept resident in the JIT, by count and by
+    bytes of object code; None leaves a limit off. The least recently used
+    ones are evicted first and compiled again when next needed.
+
+    Evicting a specialization removes its module from the engine and drops
+    the wrappers around it, but MCJIT does not hand the pages its machine
+    code was loaded into back to the system: the limits bound how many
+    specializations are callable and the compiler state kept for them, not
+    the process's JIT memory, which keeps growing with every compile.
+    """
+    function_cache.set_limits(max_entries, max_bytes)
+
+
+def resident_code_size():
+    """
+    Bytes of object code held by the specializations currently resident.
+    Code of evicted ones still occupies JIT memory, see ``set_cache_limits``.
+    """
+    return function_cache.code_size
+
+
+from numpile.autojit import autojit, compile_module, precompile
+from numpile.instrument import stats, enable_stats, add_stats_hook, remove_stats_hook
+from numpile.parallel import prange, set_num_threads, get_num_threads
+from numpile.aot import load_library
+from numpile.vectorize import vectorize
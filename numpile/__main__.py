@@ -1,8 +1,12 @@
+import argparse
+import sys
+
 import llvmlite.llvmpy.core as ll_core
 
 # All these initializations are required for code generation!
 import numpy as np
 
+from numpile.aot import compile_library, load_kernels
 from numpile.autojit import autojit
 from numpile.solve import apply, solve
 from numpile.transformer import TypeInfer
@@ -19,7 +23,70 @@ def func(name, module, rettype, argtypes):
     return lfunc, builder
 
 
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m numpile")
+    commands = parser.add_subparsers(dest="command")
+
+    aot = commands.add_parser("aot", help="compile kernels to a shared library")
+    aot.add_argument("module", help="module name or .py file defining the kernels")
+    aot.add_argument("-o", "--output", required=True, help="shared library to write")
+    aot.add_argument("--opt", type=int, default=3, choices=range(4))
+    aot.add_argument("--cpu", default="", help="target CPU, 'host' for this machine")
+
+    bench = commands.add_parser("bench", help="time kernels against NumPy and pure Python")
+    bench.add_argument("kernels", nargs="*", help="benchmarks to run, all by default")
+    bench.add_argument("--dtypes", nargs="+", help="dtypes to run, all a kernel supports by default")
+    bench.add_argument("--sizes", nargs="+", type=int, help="elements per array")
+    bench.add_argument("--python-max", type=int, help="largest size to time pure Python at")
+    bench.add_argument("--repeat", type=int, default=3)
+    bench.add_argument("--opt", type=int, default=3, choices=range(4))
+    bench.add_argument("--reassoc", action="store_true", help="split float reductions")
+    bench.add_argument("--fastmath", action="store_true", help="all fast-math flags")
+    bench.add_argument("--micro", action="store_true", help="also run the compiler microbenchmarks")
+    bench.add_argument("-o", "--output", help="JSON file to write the results to")
+    bench.add_argument("--baseline", help="JSON results to compare with, fails on regressions")
+    bench.add_argument("--tolerance", type=float, default=0.1,
+                       help="slowdown against the baseline tolerated, as a fraction")
+
+    args = parser.parse_args(argv)
+    if args.command == "aot":
+        kernels = load_kernels(args.module)
+        manifest = compile_library(kernels, args.output, opt=args.opt, cpu=args.cpu)
+        for entry in manifest:
+            print("%s(%s) -> %s" % (entry["name"], ", ".join(entry["argtys"]), entry["retty"]))
+    elif args.command == "bench":
+        return run_bench(args)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+def run_bench(args):
+    from numpile import bench
+
+    results = bench.run(args.kernels, args.dtypes, args.sizes or bench.SIZES,
+                        bench.runner.PYTHON_MAX if args.python_max is None else args.python_max,
+                        args.repeat,
+                        opt=args.opt, reassoc=args.reassoc, fastmath=args.fastmath)
+    if args.micro:
+        results['micro'] = dict((name, fn()) for (name, fn) in bench.MICRO.items())
+    bench.report(results)
+    if args.output:
+        bench.write(results, args.output)
+    if args.baseline:
+        regressions = bench.compare(bench.load(args.baseline), results, args.tolerance)
+        for regression in regressions:
+            print("regression:", regression)
+        if regressions:
+            return 1
+    return 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
+
     print("Starting llvm")
 
     def transform():
@@ -113,7 +180,7 @@ if __name__ == "__main__":
         @autojit
         def dot2(a, b):
             c = 0
-            n = 3 # a.shape[0]
+            n = a.shape[0]
             for i in range(n):
                 c += a[i] * b[i]
             return c
@@ -0,0 +1,153 @@
+import ctypes
+import importlib
+import importlib.util
+import itertools
+import json
+import os
+import subprocess
+import tempfile
+
+import llvmlite.binding as llvm
+
+from numpile import create_target_machine
+from numpile.autojit import ALIASED, Kernel, overlap, pytype_key, type_key
+from numpile.parallel import parallel_entry
+from numpile.pytypes import from_str
+from numpile.transformer import cfunctype, dispatcher, entry_type, mangler, optimize_module, \
+    trailing_args, variant_name
+
+
+def manifest_path(path):
+    return path + '.json'
+
+
+def compile_library(kernels, output, opt=3, cpu=''):
+    """
+    Compile every declared signature of ``kernels`` into one shared library
+    at ``output``. A manifest of the exported specializations is written
+    next to it, which is all ``load_library`` needs to bind them again.
+    """
+    mod = None
+    manifest = []
+    for kernel in kernels:
+        for (sig, noalias) in itertools.product(kernel.signatures, kernel.variants()):
+            llfunc, retty, argtys = kernel.emit(list(sig), noalias=noalias)
+            llmod = llvm.parse_assembly(str(llfunc.module))
+            if mod is None:
+                mod = llmod
+            else:
+                mod.link_in(llmod)
+            manifest.append({
+                'name': kernel.__name__,
+                'symbol': llfunc.name,
+                # The kernel itself, callable from C with arrays flattened.
+                'c_symbol': mangler(variant_name(kernel.ast.fname, noalias), argtys),
+                'ranks': kernel.ranks,
+                'argtys': list(map(str, argtys)),
+                'retty': str(retty),
+                'parallel': kernel.parallel,
+                'reduction': kernel.reduction,
+                'schedule': kernel.schedule,
+                'written': kernel.written,
+                'checked': kernel.checked,
+                'noalias': noalias,
+            })
+    if mod is None:
+        raise ValueError("No signatures to compile ahead of time")
+
+    if cpu == 'host':
+        cpu = llvm.get_host_cpu_name()
+    machine = create_target_machine(cpu=cpu, reloc='pic', codemodel='default')
+    mod.triple = machine.triple
+    mod.data_layout = str(machine.target_data)
+    mod.verify()
+    optimize_module(mod, opt, machine=machine)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        obj = os.path.join(tmp, 'numpile.o')
+        with open(obj, 'wb') as f:
+            f.write(machine.emit_object(mod))
+        cc = os.environ.get('CC', 'cc')
+        subprocess.check_call([cc, '-shared', '-o', output, obj])
+
+    with open(manifest_path(output), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_kernels(module):
+    """
+    Import ``module``, either a dotted name or a path to a ``.py`` file, and
+    return the kernels it defines with declared signatures.
+    """
+    if module.endswith('.py'):
+        name = os.path.splitext(os.path.basename(module))[0]
+        spec = importlib.util.spec_from_file_location(name, module)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    else:
+        mod = importlib.import_module(module)
+    return [v for v in vars(mod).values() if isinstance(v, Kernel) and v.signatures]
+
+
+class AotKernel(object):
+    """
+    A kernel bound from a shared library. It dispatches like ``Kernel`` but
+    can only call the specializations that were compiled ahead of time.
+    """
+
+    def __init__(self, name, lib):
+        self.__name__ = name
+        self.lib = lib
+        self.dispatch = {}
+        self.written = []
+
+    def bind(self, entry):
+        argtys = list(map(from_str, entry['argtys']))
+        retty = from_str(entry['retty'])
+        extra = trailing_args(entry.get('parallel'), entry.get('checked'))
+        func_ptr = ctypes.cast(getattr(self.lib, entry['symbol']), ctypes.c_void_p).value
+        cfunc = cfunctype(entry_type(argtys, retty, extra))(func_ptr)
+        cfunc.__name__ = entry['symbol']
+        pyfunc = dispatcher(cfunc, argtys, entry['ranks'], entry.get('checked'))
+        if entry.get('parallel'):
+            pyfunc = parallel_entry(pyfunc, entry['reduction'], entry['schedule'])
+        keys = tuple(map(pytype_key, argtys, entry['ranks']))
+        if not entry.get('noalias', True):
+            keys += (ALIASED,)
+        self.dispatch[keys] = pyfunc
+        self.written = entry.get('written', [])
+
+    def __call__(self, *args):
+        key = tuple(map(type_key, args))
+        if self.written and overlap(args, self.written):
+            key += (ALIASED,)
+        entry = self.dispatch.get(key)
+        if entry is None:
+            raise TypeError("No ahead-of-time specialization of %s for %s"
+                            % (self.__name__, [type_key(a) for a in args]))
+        return entry(*args)
+
+
+class Library(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lib = ctypes.CDLL(os.path.abspath(path))
+        self.kernels = {}
+        with open(manifest_path(path)) as f:
+            manifest = json.load(f)
+        for entry in manifest:
+            if entry['name'] not in self.kernels:
+                self.kernels[entry['name']] = AotKernel(entry['name'], self.lib)
+            self.kernels[entry['name']].bind(entry)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['kernels'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def load_library(path):
+    return Library(path)
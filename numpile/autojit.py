@@ -1,19 +1,36 @@
-import sys
+import ast
+import hashlib
+import inspect
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import llvmlite.llvmpy.core as ll_core
 import numpy as np
 
-from numpile import function_cache
-from numpile.lang import TFun, TVar
+from numpile import engine, function_cache, instrument, object_cache
+from numpile.cache import specialization_key
+from numpile.instrument import KernelStats, Timer
+from numpile.lang import TFun, TVar, App, Store, Var
+from numpile.parallel import parallel_entry
 from numpile.pytypes import array, int32, int64, double64, float32, determined
+from numpile.reduction import parallel_loop, parallel_reduction
 from numpile.solve import solve, apply, compose, unify, UnderDeteremined
-from numpile.transformer import TypeInfer, mangler, wrap_module
+from numpile.transformer import TypeInfer, array_ranks, batch_dispatcher, dispatcher, \
+    driver_type, load_cached, load_cached_many, mangler, may_fail, trailing_args, variant_name, \
+    wrap_cached, wrap_function, wrap_functions, wrap_module
 from numpile.visitor import PythonVisitor
 
 
-def typeinfer(ast):
-    infer = TypeInfer()
-    ty = infer.visit(ast)
-    mgu = solve(infer.constraints)
-    infer_ty = apply(mgu, ty)
+def typeinfer(ast, timer=None, functions=None):
+    timer = timer or Timer({})
+    with timer('infer'):
+        infer = TypeInfer(functions)
+        ty = infer.visit(ast)
+    with timer('solve'):
+        mgu = solve(infer.constraints)
+        infer_ty = apply(mgu, ty)
     return infer_ty, mgu
 
 
@@ -25,9 +42,9 @@ def arg_pytype(arg):
             return array(int64)
         elif arg.dtype == np.dtype('double'):
             return array(double64)
-        elif arg.dtype == np.dtype('float'):
+        elif arg.dtype == np.dtype('float32'):
             return array(float32)
-    elif isinstance(arg, int) & (arg < sys.maxsize):
+    elif isinstance(arg, int) and in_int64(arg):
         return int64
     elif isinstance(arg, float):
         return double64
@@ -35,45 +52,674 @@ def arg_pytype(arg):
         raise Exception("Type not supported: %s" % type(arg))
 
 
-def specialize(ast, infer_ty, mgu):
-    def _wrapper(*args):
-        types = list(map(arg_pytype, list(args)))
+_scalar_keys = frozenset([int, float])
+
+
+def in_int64(n):
+    # Ints outside int64 would be truncated passing them to a kernel.
+    return -2 ** 63 <= n < 2 ** 63
+
+
+def type_key(arg):
+    """
+    The cheap part of ``arg_pytype``: everything inference depends on, as a
+    hashable value that can be built without touching the type language.
+    """
+    cls = type(arg)
+    if cls in _scalar_keys:
+        if cls is int and not in_int64(arg):
+            # No specialization takes it, the slow path reports why.
+            return None
+        return cls
+    if isinstance(arg, np.ndarray):
+        return (cls, arg.dtype, arg.ndim)
+    return cls
+
+
+def written_args(fun, functions=None):
+    """
+    Positions of the arguments of ``fun`` that it stores into, itself or
+    through the kernels in ``functions`` it passes them to.
+    """
+    functions = functions or {}
+    stored = set(n.ref.id for n in ast.walk(fun) if isinstance(n, Store))
+    for node in ast.walk(fun):
+        if isinstance(node, App) and getattr(node.fn, 'id', None) in functions:
+            written = functions[node.fn.id].written
+            stored.update(arg.id for (k, arg) in enumerate(node.args)
+                          if k in written and isinstance(arg, Var))
+    return [k for (k, arg) in enumerate(fun.args) if arg.id in stored]
+
+
+def callees(fn, fun):
+    """
+    The kernels the function ``fn``, parsed as ``fun``, calls, by the name
+    it calls them by. They are looked up in its globals and closure when it
+    is jitted, so have to be defined before it.
+    """
+    names = set(n.fn.id for n in ast.walk(fun) if isinstance(n, App) and isinstance(n.fn, Var))
+    if not names or not callable(fn):
+        return {}
+    scope = dict(fn.__globals__)
+    scope.update(inspect.getclosurevars(fn).nonlocals)
+    return dict((name, scope[name]) for name in names if isinstance(scope.get(name), Kernel))
+
+
+def overlap(args, written):
+    """
+    Whether an array argument at one of the ``written`` positions shares
+    memory with any other array argument. Distinct arrays owning their
+    buffers can't, and the bounds check of ``may_share_memory`` settles
+    most others; the exact test only runs when their extents overlap.
+    """
+    for k in written:
+        a = args[k]
+        for (n, b) in enumerate(args):
+            if n == k or not isinstance(b, np.ndarray):
+                continue
+            if a.base is None and b.base is None and a is not b:
+                continue
+            if np.may_share_memory(a, b) and np.shares_memory(a, b):
+                return True
+    return False
+
+
+# LLVM's fast-math flags; 'fast' is all of them.
+FASTMATH_FLAGS = ('reassoc', 'nnan', 'ninf', 'nsz', 'arcp', 'contract', 'afn', 'fast')
+
+
+def fastmath_flags(fastmath):
+    """
+    The flags ``autojit(fastmath=...)`` asks for, in a stable order: all of
+    them for True, none for False, else the named ones.
+    """
+    if fastmath is True:
+        return ('fast',)
+    if not fastmath:
+        return ()
+    if isinstance(fastmath, str):
+        fastmath = [fastmath]
+    unknown = set(fastmath) - set(FASTMATH_FLAGS)
+    if unknown:
+        raise ValueError("Unknown fast-math flags: %s" % ', '.join(sorted(unknown)))
+    return tuple(sorted(set(fastmath)))
+
+
+# Appended to the dispatch key of calls that need the conservative build.
+ALIASED = 'aliased'
+
+
+_pytype_keys = {
+    int64: int,
+    double64: float,
+}
+
+_array_dtypes = {
+    array(int32): np.dtype('int32'),
+    array(int64): np.dtype('int64'),
+    array(float32): np.dtype('float32'),
+    array(double64): np.dtype('double'),
+}
+
+
+def pytype_key(ty, rank=1):
+    """
+    The ``type_key`` of the arguments that ``arg_pytype`` maps to ``ty``, or
+    None when no Python value has that type. Arrays are keyed on the
+    ``rank`` the kernel indexes them with, as in ``array_ranks``.
+    """
+    if ty in _array_dtypes:
+        return (np.ndarray, _array_dtypes[ty], max(rank, 1))
+    return _pytype_keys.get(ty)
+
+
+class Kernel(object):
+    """
+    A jitted function. Calls are dispatched on the ``type_key`` of their
+    arguments straight to the compiled entry; unification and codegen only
+    run the first time a combination of argument types is seen.
+    """
+
+    def __init__(self, ast, infer_ty, mgu, source, options, signatures=(),
+                 schedule='static', codegen_options=None, max_specializations=None,
+                 py_func=None, background=False, hot_calls=None, functions=None):
+        self.ast = ast
+        self.infer_ty = infer_ty
+        self.mgu = mgu
+        self.source = source
+        self.options = options
+        self.codegen_options = codegen_options or {}
+        # Kernels it calls, compiled into each of its specializations.
+        self.functions = functions or {}
+        self.fingerprint = source + ''.join(
+            '\0%s %s %s' % (name, f.fingerprint, sorted(f.codegen_options.items()))
+            for (name, f) in sorted(self.functions.items()))
+        self.signatures = list(signatures)
+        self.dispatch = {}
+        # Native loops over many argument sets, for ``map``.
+        self.drivers = {}
+        self.__name__ = ast.fname
+        # Kernels with a prange loop run as chunks on the thread pool.
+        self.parallel = parallel_loop(ast) is not None
+        self.reduction = parallel_reduction(ast) if self.parallel else None
+        self.schedule = schedule
+        # Specializations assume array arguments don't overlap; calls where
+        # an array the kernel writes to does get a conservative build.
+        self.written = written_args(ast, self.functions)
+        self.ranks = array_ranks(ast, self.functions)
+        # Kernels that can fail report it through a status pointer.
+        self.checked = may_fail(ast, self.functions)
+        self.instrument = KernelStats(self)
+        self.max_specializations = max_specializations
+        # In the background mode calls run ``py_func`` until the compile
+        # worker has built their specialization.
+        self.py_func = py_func
+        self.background = background
+        self.pending = {}
+        # Keys whose compile failed; they keep running ``py_func``.
+        self.failed = set()
+        self.lock = threading.Lock()
+        # Tiered kernels first build a specialization cheaply and rebuild
+        # it with the full options, for this CPU, once it made ``hot_calls``.
+        self.hot_calls = hot_calls
+        self.calls = {}
+        self.hot = set()
+        self.cold_options = dict(options, opt=min(options['opt'], 1), vectorize=False, slp=False)
+        self.hot_options = dict(options, host=True)
+
+    def __call__(self, *args):
+        key = tuple(map(type_key, args))
+        noalias = not (self.written and overlap(args, self.written))
+        if not noalias:
+            key += (ALIASED,)
+        entry = self.dispatch.get(key)
+        if entry is None:
+            if self.background:
+                return self.call_interpreted(key, args, noalias)
+            entry = self.dispatch[key] = self.specialize(list(map(arg_pytype, args)), noalias,
+                                                         self.tier_options())
+        if self.hot_calls is not None and key not in self.hot:
+            self.count(key, args, noalias)
+        if self.max_specializations is not None or function_cache.bounded:
+            # Only while a limit can evict anything is recency tracked and
+            # the code pinned, so an eviction can't release it mid-call.
+            with function_cache.pinned(getattr(entry, '__wrapped__', entry).cache_key) as resident:
+                if resident:
+                    return self.run(key, entry, args)
+            # Evicted since it was looked up, compile it again.
+            if self.dispatch.get(key) is entry:
+                self.dispatch.pop(key, None)
+            return self(*args)
+        return self.run(key, entry, args)
+
+    def run(self, key, entry, args):
+        if instrument.enabled:
+            start = time.perf_counter()
+            result = entry(*args)
+            self.instrument.called(key, time.perf_counter() - start)
+            return result
+        return entry(*args)
+
+    def map(self, args_list):
+        """
+        Call the kernel on every tuple of arguments in ``args_list`` and
+        return the list of results. Tuples of the same argument types run
+        in one native call, a loop around their specialization, instead of
+        one call each.
+        """
+        groups = {}
+        for (n, args) in enumerate(args_list):
+            key = tuple(map(type_key, args))
+            if self.written and overlap(args, self.written):
+                key += (ALIASED,)
+            groups.setdefault(key, []).append(n)
+
+        if len(groups) == 1:
+            # Commonly all of the same types, as they come.
+            (key, members), = groups.items()
+            return self.map_group(key, args_list)
+        results = [None] * len(args_list)
+        for (key, members) in groups.items():
+            values = self.map_group(key, [args_list[n] for n in members])
+            for (n, value) in zip(members, values):
+                results[n] = value
+        return results
+
+    def map_group(self, key, sets):
+        driver = self.drivers.get(key)
+        if driver is None:
+            driver = self.drivers[key] = self.compile_driver(
+                list(map(arg_pytype, sets[0])), ALIASED not in key)
+        if self.max_specializations is not None or function_cache.bounded:
+            with function_cache.pinned(driver.cache_key) as resident:
+                if resident:
+                    return self.run_driver(key, driver, sets)
+            if self.drivers.get(key) is driver:
+                self.drivers.pop(key, None)
+            return self.map_group(key, sets)
+        return self.run_driver(key, driver, sets)
+
+    def run_driver(self, key, driver, sets):
+        if instrument.enabled:
+            start = time.perf_counter()
+            values = driver(sets)
+            self.instrument.called(key, time.perf_counter() - start, len(sets))
+            return values
+        return driver(sets)
+
+    def call_interpreted(self, key, args, noalias):
+        with self.lock:
+            if key not in self.pending and key not in self.dispatch and key not in self.failed:
+                types = list(map(arg_pytype, args))
+                self.pending[key] = get_compiler().submit(self.compile_pending, key,
+                                                          types, noalias, self.tier_options())
+        return self.py_func(*args)
+
+    def compile_pending(self, key, types, noalias, options=None):
+        try:
+            self.install(key, self.specialize(types, noalias, options))
+        except Exception as e:
+            warnings.warn("Compiling %s for %s failed, it keeps running as before: %s"
+                          % (self.__name__, types, e))
+            if key not in self.dispatch:
+                self.failed.add(key)
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def tier_options(self):
+        # What a first call compiles with.
+        return self.cold_options if self.hot_calls is not None else None
+
+    def count(self, key, args, noalias):
+        calls = self.calls[key] = self.calls.get(key, 0) + 1
+        if calls < self.hot_calls:
+            return
+        self.hot.add(key)
+        types = list(map(arg_pytype, args))
+        if self.background:
+            with self.lock:
+                self.pending[key] = get_compiler().submit(self.compile_pending, key, types,
+                                                          noalias, self.hot_options)
+        else:
+            self.install(key, self.specialize(types, noalias, self.hot_options))
+
+    def install(self, key, entry):
+        # A single dict store publishes the entry, calls racing with it see
+        # either the previous entry or the new one. A previous, colder build
+        # of the same types is dropped from the function cache afterwards.
+        previous = self.dispatch.get(key)
+        self.dispatch[key] = entry
+        previous = getattr(previous, '__wrapped__', previous)
+        cache_key = getattr(previous, 'cache_key', None)
+        if cache_key is not None and cache_key != getattr(entry, '__wrapped__', entry).cache_key:
+            function_cache.discard(cache_key)
+
+    def wait(self):
+        """
+        Block until the background compiles started so far have finished.
+        """
+        for future in list(self.pending.values()):
+            future.result()
+
+    @property
+    def stats(self):
+        """
+        Compile timings per phase and per specialization, cache hits and
+        misses and, once ``numpile.enable_stats()`` is on, calls and the time
+        spent in them.
+        """
+        return self.instrument.snapshot()
+
+    def compile(self, signature):
+        """
+        Compile the specialization for the argument types in ``signature``
+        ahead of the first call that needs it. Tiered kernels build it cheaply
+        too, like a first call would.
+        """
+        return self.bind(signature, self.compile_entry(list(signature),
+                                                       options=self.tier_options()))
+
+    def bind(self, signature, pyfunc):
+        """
+        Make the compiled ``pyfunc`` the target of calls matching
+        ``signature``.
+        """
+        entry = self.wrap_entry(pyfunc)
+        keys = list(map(pytype_key, signature, self.ranks))
+        if None not in keys:
+            self.dispatch[tuple(keys)] = entry
+        return entry
+
+    def unify(self, types):
+        """
+        Solve the kernel's type against concrete argument ``types``. Returns
+        the substitution along with the specialized return and argument types.
+        """
         spec_ty = TFun(argtys=types, retty=TVar("$retty"))
-        unifier = unify(infer_ty, spec_ty)
-        specializer = compose(unifier, mgu)
+        unifier = unify(self.infer_ty, spec_ty)
+        specializer = compose(unifier, self.mgu)
 
         retty = apply(specializer, TVar("$retty"))
         argtys = [apply(specializer, ty) for ty in types]
-        print('Specialized Function:', TFun(argtys, retty))
-
-        if determined(retty) and all(list(map(determined, argtys))):
-            key = mangler(ast.fname, argtys)
-            # Don't recompile after we've specialized.
-            if key in function_cache:
-                return function_cache[key](*args)
-            else:
-                llfunc = codegen(ast, specializer, retty, argtys)
-                pyfunc = wrap_module(argtys, llfunc)
-                function_cache[key] = pyfunc
-                return pyfunc(*args)
-        else:
+
+        if not (determined(retty) and all(list(map(determined, argtys)))):
             raise UnderDeteremined()
-    return _wrapper
+        return specializer, retty, argtys
+
+    def emit(self, types, module=None, noalias=True):
+        """
+        Emit LLVM IR for one specialization without compiling it. With
+        ``noalias`` the code assumes its array arguments don't overlap.
+        """
+        specializer, retty, argtys = self.unify(types)
+        llfunc = codegen(self.ast, specializer, retty, argtys, module,
+                         noalias=noalias, functions=self.functions,
+                         **self.codegen_options)
+        return llfunc, retty, argtys
+
+    def cache_key(self, argtys, *extra, options=None):
+        options = options or self.options
+        return specialization_key(self.fingerprint, argtys, sorted(options.items()),
+                                  sorted(self.codegen_options.items()), *extra)
+
+    def variants(self):
+        """
+        The ``noalias`` settings a signature has to be built with to serve
+        every call: the conservative build is only needed when the kernel
+        writes to an array that another argument could overlap.
+        """
+        if self.written and len(self.ast.args) > 1:
+            return [True, False]
+        return [True]
+
+    def specialize(self, types, noalias=True, options=None):
+        return self.wrap_entry(self.compile_entry(types, noalias, options))
+
+    def wrap_entry(self, pyfunc):
+        if self.parallel:
+            return parallel_entry(pyfunc, self.reduction, self.schedule)
+        return pyfunc
 
+    def compile_entry(self, types, noalias=True, options=None):
+        options = options or self.options
+        record = {}
+        timer = Timer(record)
+        with timer('unify'):
+            specializer, retty, argtys = self.unify(types)
+        record.update(signature=str(TFun(argtys, retty)), noalias=noalias, opt=options['opt'],
+                      host=options.get('host', False))
 
-def codegen(ast, specializer, retty, argtys):
+        # Don't recompile after we've specialized. The key covers the source
+        # and options, so same-named kernels built differently don't collide.
+        cache_key = self.cache_key(argtys, *([] if noalias else [ALIASED]), options=options)
+        pyfunc = function_cache.get(cache_key, self.evicted)
+        if pyfunc is not None:
+            record['source'] = 'memory'
+            self.instrument.specialized(self.__name__, record)
+            return pyfunc
+
+        extra = trailing_args(self.parallel, self.checked)
+        record['source'] = 'disk'
+        if object_cache.contains(cache_key):
+            pyfunc = wrap_cached(self.ast.fname, argtys, retty, cache_key, extra, noalias,
+                                 self.ranks, self.checked)
+        if pyfunc is None:
+            record['source'] = 'compiled'
+            with timer('emit'):
+                llfunc = codegen(self.ast, specializer, retty, argtys,
+                                 noalias=noalias, functions=self.functions,
+                                 **self.codegen_options)
+            pyfunc = wrap_module(argtys, llfunc, cache_key, self.ranks, self.checked, **options)
+        record.update(pyfunc.timings)
+        self.resident(cache_key, pyfunc, record, pyfunc.module.code_size)
+        return pyfunc
+
+    def compile_driver(self, types, noalias=True):
+        from numpile.emitter import emit_driver
+
+        record = {}
+        timer = Timer(record)
+        with timer('unify'):
+            specializer, retty, argtys = self.unify(types)
+        record.update(signature=str(TFun(argtys, retty)), noalias=noalias, driver=True)
+
+        cache_key = self.cache_key(argtys, 'map', *([] if noalias else [ALIASED]))
+        pyfunc = function_cache.get(cache_key, self.evicted)
+        if pyfunc is not None:
+            record['source'] = 'memory'
+            self.instrument.specialized(self.__name__, record)
+            return pyfunc
+
+        symbol = mangler(variant_name(self.ast.fname, noalias) + '_map', argtys)
+        record['source'] = 'disk'
+        cfunc = None
+        if object_cache.contains(cache_key):
+            cfunc = load_cached(cache_key, symbol, driver_type(argtys, retty, self.checked))
+        if cfunc is None:
+            record['source'] = 'compiled'
+            with timer('emit'):
+                entry, retty, argtys = self.emit(types, noalias=noalias)
+                # Only reachable through the driver, so it can be inlined away.
+                entry.linkage = 'internal'
+                driver = emit_driver(entry, argtys, retty, symbol)
+            cfunc = wrap_function(driver, engine, cache_key, **self.options)
+        pyfunc = batch_dispatcher(cfunc, argtys, retty, self.ranks, self.checked)
+        record.update(pyfunc.timings)
+        self.resident(cache_key, pyfunc, record, pyfunc.module.code_size)
+        return pyfunc
+
+    def resident(self, cache_key, pyfunc, record, size):
+        # Account for freshly built or loaded code and hand it to the
+        # function cache, which decides how long it stays.
+        self.instrument.specialized(self.__name__, record)
+        pyfunc.cache_key = cache_key
+        function_cache.put(cache_key, pyfunc, pyfunc.module, size,
+                           self, self.max_specializations, self.evicted)
+
+    def evicted(self, cache_key, pyfunc):
+        # The code is about to be released: forget every entry that runs
+        # it, so the next call with those types compiles it again, from the
+        # cold tier and counting its calls anew.
+        for table in (self.dispatch, self.drivers):
+            for (key, entry) in list(table.items()):
+                if getattr(entry, '__wrapped__', entry) is pyfunc:
+                    table.pop(key, None)
+                    if table is self.dispatch:
+                        self.hot.discard(key)
+                        self.calls.pop(key, None)
+
+
+def codegen(ast, specializer, retty, argtys, module=None, functions=None, **codegen_options):
     from numpile.emitter import LLVMEmitter
 
-    cgen = LLVMEmitter(specializer, retty, argtys)
+    cgen = LLVMEmitter(specializer, retty, argtys, module, functions=functions,
+                       **codegen_options)
     mod = cgen.visit(ast)
     # cgen.function.verify()
-    print(cgen.function)
     # print(target.emit_assembly(mod))
-    return cgen.function
+    return cgen.entry
+
+
+_compiler = None
+_compiler_lock = threading.Lock()
+
+
+def get_compiler():
+    # One worker builds background specializations, off the threads that
+    # call kernels.
+    global _compiler
+    with _compiler_lock:
+        if _compiler is None:
+            _compiler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='numpile-compile')
+        return _compiler
+
+
+def precompile(kernels):
+    """
+    Compile many specializations up front. Each item is either a ``Kernel``,
+    for all of its declared signatures, or a ``(kernel, signature)`` pair.
+    They are built one after the other: llvmlite serializes every call into
+    LLVM behind one lock, so threads would not overlap any of the work. See
+    ``compile_module`` to build them as one LLVM module instead.
+    """
+    jobs = []
+    for item in kernels:
+        if isinstance(item, Kernel):
+            jobs += [(item, tuple(sig)) for sig in item.signatures]
+        else:
+            kernel, sig = item
+            jobs.append((kernel, tuple(sig)))
+    # The same specialization requested twice would be built twice.
+    jobs = list(dict.fromkeys(jobs))
+
+    return [kernel.compile(sig) for (kernel, sig) in jobs]
+
+
+def compile_module(mod, signatures=None):
+    """
+    Compile the kernels of the Python module ``mod`` together: one LLVM
+    module per set of compile options, parsed, optimized and finalized by
+    the engine once, instead of once per specialization. ``signatures`` maps
+    kernel names to the argument types to build, by default each kernel's
+    declared ``signatures``; plain functions named there are jitted, and
+    replaced in ``mod``, first. Returns the kernels by name.
+    """
+    signatures = dict(signatures or {})
+    kernels = {}
+    for (name, obj) in list(vars(mod).items()):
+        if isinstance(obj, Kernel):
+            kernels[name] = obj
+        elif name in signatures and callable(obj):
+            kernels[name] = autojit(obj)
+            setattr(mod, name, kernels[name])
+
+    groups = {}
+    for (name, kernel) in kernels.items():
+        for sig in signatures.get(name, kernel.signatures):
+            key = tuple(sorted((kernel.tier_options() or kernel.options).items()))
+            groups.setdefault(key, []).append((kernel, tuple(sig)))
+    for (options, jobs) in groups.items():
+        compile_batch(jobs, dict(options))
+    return kernels
+
+
+def compile_batch(jobs, options):
+    # Everything in one module, skipping what is resident already. A
+    # specialization whose symbol is taken, by a same-named kernel, is left
+    # to the regular path.
+    shared = ll_core.Module('numpile.batch')
+    symbols = set()
+    batch = []
+    for (kernel, sig) in dict.fromkeys(jobs):
+        record = {}
+        timer = Timer(record)
+        with timer('unify'):
+            specializer, retty, argtys = kernel.unify(list(sig))
+        cache_key = kernel.cache_key(argtys, options=options)
+        pyfunc = function_cache.get(cache_key, kernel.evicted)
+        if pyfunc is not None:
+            kernel.bind(sig, pyfunc)
+            continue
+        symbol = mangler(kernel.ast.fname, argtys)
+        if symbol in symbols:
+            kernel.compile(sig)
+            continue
+        symbols.add(symbol)
+        with timer('emit'):
+            llfunc = codegen(kernel.ast, specializer, retty, argtys, shared,
+                             functions=kernel.functions, **kernel.codegen_options)
+        record.update(signature=str(TFun(argtys, retty)), noalias=True)
+        batch.append((kernel, sig, argtys, llfunc, cache_key, record))
+    if not batch:
+        return
+
+    # The batch is cached on disk as one object, under a key of its members.
+    batch_key = hashlib.sha256(''.join(job[4] for job in batch).encode('utf-8')).hexdigest()
+    source = 'disk'
+    cfuncs = None
+    if object_cache.contains(batch_key):
+        cfuncs = load_cached_many(batch_key, [(llfunc.name, llfunc.type.pointee)
+                                              for (_, _, _, llfunc, _, _) in batch])
+    if cfuncs is None:
+        source = 'compiled'
+        cfuncs = wrap_functions([llfunc for (_, _, _, llfunc, _, _) in batch],
+                                engine, batch_key, **options)
+    size = cfuncs[0].module.code_size // len(batch)
+    for ((kernel, sig, argtys, llfunc, cache_key, record), cfunc) in zip(batch, cfuncs):
+        pyfunc = dispatcher(cfunc, argtys, kernel.ranks, kernel.checked)
+        record.update(pyfunc.timings, source=source, batch=len(batch))
+        kernel.resident(cache_key, pyfunc, record, size)
+        kernel.bind(sig, pyfunc)
+
+
+def autojit(fn=None, opt=3, vectorize=True, slp=True, signatures=(),
+            schedule='static', reassoc=False, accumulators=4, fastmath=False,
+            max_specializations=None, background=False, tiered=False, hot_calls=1000):
+    """
+    Compile ``fn`` lazily for each new set of argument types. ``opt`` selects
+    the LLVM optimization level (0-3) and ``vectorize``/``slp`` enable the
+    loop and SLP vectorizers. Each tuple of types in ``signatures`` is instead
+    compiled eagerly, when the function is decorated. A ``prange`` loop is
+    split into chunks run on the thread pool, one per thread with the
+    'static' ``schedule`` or many smaller ones with 'dynamic'. Usable both as
+    ``@autojit`` and ``@autojit(...)``.
+
+    Reductions in loops (``c += ...``, ``c *= ...``) are spread over
+    ``accumulators`` independent partial results that are combined after the
+    loop, which breaks the loop-carried dependency. Integer reductions are
+    always split. Floating point ones are only split when ``reassoc`` is
+    True, since summing in a different order can change the result in the
+    last bits; prange kernels always combine per-thread partials in a tree.
+
+    ``fastmath`` puts LLVM's fast-math flags on the kernel's floating point
+    instructions: all of them when True, or a set of names such as
+    ``{'reassoc', 'contract'}``. 'reassoc' also lets LLVM vectorize float
+    reductions and implies ``reassoc``; 'nnan' and 'ninf' assume no NaNs or
+    infinities turn up, results are undefined if they do. The flags are
+    part of each specialization's cache key.
+
+    At most ``max_specializations`` of the kernel stay resident, the least
+    recently used beyond that are evicted; see also
+    ``numpile.set_cache_limits`` for a limit across all kernels.
+
+    With ``background`` a call with new argument types never waits for LLVM:
+    it runs ``fn`` as plain Python while a worker thread compiles, and calls
+    switch to the native specialization once it is ready.
 
+    A ``tiered`` kernel compiles each new specialization quickly, at O1 at
+    most and without the vectorizers, and counts its calls. After
+    ``hot_calls`` of them it is rebuilt with the full options, tuned for
+    the host CPU, and replaces the cheap build. Together with ``background``
+    calls keep running, in Python and then in the cheap build, while either
+    is compiled. Declared ``signatures`` get the cheap build as well.
+    """
+    if fn is None:
+        return lambda fn: autojit(fn, opt=opt, vectorize=vectorize, slp=slp,
+                                  signatures=signatures, schedule=schedule,
+                                  reassoc=reassoc, accumulators=accumulators,
+                                  fastmath=fastmath, max_specializations=max_specializations,
+                                  background=background, tiered=tiered,
+                                  hot_calls=hot_calls)
 
-def autojit(fn):
+    assert 0 <= opt <= 3
+    if background and not callable(fn):
+        raise ValueError("Background compilation needs a Python function to fall back on")
+    options = dict(opt=opt, vectorize=vectorize, slp=slp)
+    codegen_options = dict(reassoc=reassoc, accumulators=accumulators,
+                           fastmath=fastmath_flags(fastmath))
+    frontend = {}
+    timer = Timer(frontend)
     transformer = PythonVisitor()
-    ast = transformer(fn)
-    (ty, mgu) = typeinfer(ast)
-    return specialize(ast, ty, mgu)
+    with timer('visit'):
+        ast = transformer(fn)
+    functions = callees(fn, ast)
+    (ty, mgu) = typeinfer(ast, timer, functions)
+    kernel = Kernel(ast, ty, mgu, transformer._source, options, signatures,
+                    schedule, codegen_options, max_specializations,
+                    fn if callable(fn) else None, background,
+                    hot_calls if tiered else None, functions)
+    kernel.instrument.analysed(kernel.__name__, frontend)
+    if kernel.signatures:
+        precompile([kernel])
+    return kernel
@@ -0,0 +1,9 @@
+"""
+Benchmarks of numpile against NumPy and pure Python: compile time, first
+call latency, per call overhead and throughput of a few representative
+kernels, plus microbenchmarks of the compiler itself. Run them with
+``python -m numpile bench``.
+"""
+from numpile.bench.kernels import BENCHMARKS, Benchmark
+from numpile.bench.micro import MICRO, infer_scaling, promotion
+from numpile.bench.runner import SIZES, best_time, compare, load, report, run, write
@@ -0,0 +1,124 @@
+import numpy as np
+
+# Plain Python kernels, jitted by the benchmarks and also run as they are
+# for the pure Python baseline.
+
+
+def add(a, b, out):
+    for i in range(a.shape[0]):
+        out[i] = a[i] + b[i]
+
+
+def dot(a, b):
+    c = 0
+    for i in range(a.shape[0]):
+        c += a[i] * b[i]
+    return c
+
+
+def total(a):
+    c = 0
+    for i in range(a.shape[0]):
+        c += a[i]
+    return c
+
+
+def saxpy(alpha, x, y, out):
+    for i in range(x.shape[0]):
+        out[i] = alpha * x[i] + y[i]
+
+
+def stencil(a, out, m, n):
+    # Five point sum over the m x n interior of ``a``.
+    for i in range(m):
+        for j in range(n):
+            out[i + 1, j + 1] = a[i, j + 1] + a[i + 1, j] + a[i + 1, j + 1] \
+                + a[i + 1, j + 2] + a[i + 2, j + 1]
+
+
+def np_add(a, b, out):
+    return np.add(a, b, out=out)
+
+
+def np_dot(a, b):
+    return np.dot(a, b)
+
+
+def np_total(a):
+    return np.sum(a, dtype=a.dtype)
+
+
+def np_saxpy(alpha, x, y, out):
+    np.multiply(x, alpha, out=out)
+    return np.add(out, y, out=out)
+
+
+def np_stencil(a, out, m, n):
+    out[1:-1, 1:-1] = a[:-2, 1:-1] + a[1:-1, :-2] + a[1:-1, 1:-1] + a[1:-1, 2:] + a[2:, 1:-1]
+    return out
+
+
+def data(rng, shape, dtype):
+    # Small integers, so integer reductions don't overflow.
+    if dtype.kind == 'f':
+        return rng.random(shape).astype(dtype)
+    return rng.integers(0, 10, shape).astype(dtype)
+
+
+def vectors(count):
+    def setup(rng, size, dtype):
+        return tuple(data(rng, size, dtype) for _ in range(count))
+    return setup
+
+
+def with_out(setup):
+    def setup_out(rng, size, dtype):
+        args = setup(rng, size, dtype)
+        return args + (np.zeros_like(args[0]),)
+    return setup_out
+
+
+def saxpy_args(rng, size, dtype):
+    alpha = 2.5 if dtype.kind == 'f' else 3
+    return (alpha, data(rng, size, dtype), data(rng, size, dtype), np.zeros(size, dtype))
+
+
+def stencil_args(rng, size, dtype):
+    side = max(3, int(round(size ** 0.5)))
+    return (data(rng, (side, side), dtype), np.zeros((side, side), dtype), side - 2, side - 2)
+
+
+class Benchmark(object):
+    """
+    A kernel with its NumPy counterpart and the argument sets to time them
+    on. ``setup(rng, size, dtype)`` builds arguments holding about ``size``
+    elements per array; kernels with an ``out`` position write their result
+    into that argument instead of returning it.
+    """
+
+    def __init__(self, name, fn, reference, setup, dtypes=None, out=None):
+        self.name = name
+        self.fn = fn
+        self.reference = reference
+        self.setup = setup
+        self.dtypes = dtypes or ['float64', 'float32', 'int64', 'int32']
+        self.out = out
+
+    def result(self, args, ret):
+        if self.out is None:
+            return ret
+        return np.array(args[self.out])
+
+    def elements(self, args):
+        return next(arg.size for arg in args if isinstance(arg, np.ndarray))
+
+
+# A Python scalar is a float64 or an int64 to numpile, so saxpy's ``alpha``
+# rules out the narrower dtypes.
+BENCHMARKS = [
+    Benchmark('add', add, np_add, with_out(vectors(2)), out=2),
+    Benchmark('dot', dot, np_dot, vectors(2)),
+    Benchmark('sum', total, np_total, vectors(1)),
+    Benchmark('saxpy', saxpy, np_saxpy, saxpy_args, ['float64', 'int64'], out=3),
+    Benchmark('stencil', stencil, np_stencil, stencil_args, out=1),
+]
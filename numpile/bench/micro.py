@@ -0,0 +1,87 @@
+import timeit
+
+import llvmlite.binding as llvm
+import numpy as np
+
+from numpile import engine, engine_lock, target
+from numpile.autojit import arg_pytype, autojit
+from numpile.solve import solve
+from numpile.transformer import TypeInfer, cfunctype, dispatcher, mangler, optimize_module
+from numpile.visitor import PythonVisitor
+
+
+def promotion(size=1000000):
+    """
+    The kernel's IR as emitted keeps every local on the stack; compare it
+    with the O0 pipeline, which promotes them, by size and speed.
+    """
+    # Named apart from the dot benchmark, whose symbol it would shadow.
+    @autojit
+    def stack_dot(a, b):
+        c = 0.0
+        n = a.shape[0]
+        for i in range(n):
+            c += a[i] * b[i]
+        return c
+
+    a = np.random.rand(size)
+    b = np.random.rand(size)
+    llfunc, _, argtys = stack_dot.emit([arg_pytype(a), arg_pytype(b)])
+
+    rows = []
+    for label, promote in [('stack', False), ('promoted', True)]:
+        mod = llvm.parse_assembly(str(llfunc.module))
+        mod.triple = target.triple
+        mod.data_layout = str(target.target_data)
+        optimize_module(mod, opt=0, promote=promote)
+        kernel = mod.get_function(mangler(stack_dot.__name__, argtys))
+        insts = [inst.opcode for block in kernel.blocks for inst in block.instructions]
+        with engine_lock:
+            engine.add_module(mod)
+            engine.finalize_object()
+            cfunc = cfunctype(llfunc.type.pointee)(engine.get_function_address(llfunc.name))
+        cfunc.__name__ = llfunc.name
+        fn = dispatcher(cfunc, argtys, stack_dot.ranks)
+        t = min(timeit.repeat(lambda: fn(a, b), number=10, repeat=5)) / 10
+        rows.append({'ir': label, 'instructions': len(insts), 'loads': insts.count('load'),
+                     'stores': insts.count('store'), 'call': t})
+    return rows
+
+
+def kernel_source(n):
+    # A straight-line kernel of ``n`` statements mixing array reductions and
+    # scalar arithmetic.
+    lines = ["def big(a, b, x):", "    c = 0.0", "    s = 0"]
+    for k in range(n):
+        if k % 3 == 0:
+            lines.append("    c += a[%d] * b[%d]" % (k % 7, k % 5))
+        elif k % 3 == 1:
+            lines.append("    v%d = x * %d" % (k, k))
+        else:
+            lines.append("    s += %d" % k)
+    lines.append("    return c")
+    return "\n".join(lines) + "\n"
+
+
+def infer_scaling(sizes=(100, 1000, 3000, 10000)):
+    """
+    Inference and constraint solving time against kernel size.
+    """
+    rows = []
+    for n in sizes:
+        core = PythonVisitor()(kernel_source(n))
+        infer = TypeInfer()
+        start = timeit.default_timer()
+        infer.visit(core)
+        middle = timeit.default_timer()
+        solve(infer.constraints)
+        end = timeit.default_timer()
+        rows.append({'statements': n, 'constraints': len(infer.constraints),
+                     'infer': middle - start, 'solve': end - middle})
+    return rows
+
+
+MICRO = {
+    'promotion': promotion,
+    'infer_scaling': infer_scaling,
+}
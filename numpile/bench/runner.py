@@ -0,0 +1,166 @@
+import json
+import platform
+import sys
+import time
+import timeit
+
+import llvmlite.binding as llvm
+import numpy as np
+
+from numpile.autojit import autojit
+from numpile.bench.kernels import BENCHMARKS
+from numpile.parallel import get_num_threads
+
+SIZES = [100, 10000, 1000000]
+# Pure Python is only timed up to this many elements, past it a single call
+# takes seconds.
+PYTHON_MAX = 10000
+# The phases of a specialization record that are spent compiling.
+COMPILE_PHASES = ('unify', 'emit', 'passes', 'finalize')
+
+
+def best_time(fn, repeat=3, min_time=0.01):
+    """
+    Seconds per call of ``fn``: the best of ``repeat`` rounds, each calling
+    it often enough to take at least ``min_time``.
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(fn, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        best = min(best, timeit.timeit(fn, number=number) / number)
+    return best
+
+
+def environment(options):
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'llvm': '.'.join(map(str, llvm.llvm_version_info)),
+        'cpu': llvm.get_host_cpu_name(),
+        'threads': get_num_threads(),
+        'options': options,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def run(names=None, dtypes=None, sizes=SIZES, python_max=PYTHON_MAX, repeat=3,
+        min_time=0.01, **options):
+    """
+    Time the ``BENCHMARKS`` named in ``names``, all by default, for each of
+    ``dtypes`` they support and each of ``sizes``. ``options`` go to
+    ``autojit``. Returns a JSON serializable dict.
+    """
+    results = []
+    for bench in BENCHMARKS:
+        if names and bench.name not in names:
+            continue
+        for dtype in bench.dtypes:
+            if dtypes and dtype not in dtypes:
+                continue
+            results.append(run_one(bench, np.dtype(dtype), sizes, python_max,
+                                   repeat, min_time, options))
+    return {'environment': environment(options), 'results': results}
+
+
+def run_one(bench, dtype, sizes, python_max, repeat, min_time, options):
+    rng = np.random.default_rng(0)
+    # A kernel of its own, so its first call compiles.
+    kernel = autojit(bench.fn, **options)
+
+    tiny = bench.setup(rng, 1, dtype)
+    start = time.perf_counter()
+    kernel(*tiny)
+    first_call = time.perf_counter() - start
+    spec = kernel.stats['specializations'][-1]
+    entry = next(iter(kernel.dispatch.values()))
+    call = best_time(lambda: kernel(*tiny), repeat, min_time)
+    result = {
+        'kernel': bench.name,
+        'dtype': dtype.name,
+        'frontend': kernel.stats['frontend'],
+        'compile': sum(spec.get(phase, 0.0) for phase in COMPILE_PHASES),
+        'source': spec['source'],
+        'first_call': first_call,
+        'call': call,
+        'dispatch': call - best_time(lambda: entry(*tiny), repeat, min_time),
+        'sizes': [],
+    }
+
+    rtol = 1e-3 if dtype == np.float32 else 1e-8
+    for size in sizes:
+        args = bench.setup(rng, size, dtype)
+        elements = bench.elements(args)
+        expected = bench.result(args, bench.reference(*args))
+        row = {
+            'size': size,
+            'elements': elements,
+            'ok': bool(np.allclose(bench.result(args, kernel(*args)), expected, rtol=rtol)),
+            'numpile': best_time(lambda: kernel(*args), repeat, min_time),
+            'numpy': best_time(lambda: bench.reference(*args), repeat, min_time),
+            'python': None,
+        }
+        if elements <= python_max:
+            row['python'] = best_time(lambda: bench.fn(*args), 1, min_time)
+        row['throughput'] = elements / row['numpile']
+        result['sizes'].append(row)
+    return result
+
+
+def write(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, results, tolerance=0.1):
+    """
+    The timings in ``results`` more than ``tolerance`` slower than the same
+    ones in ``baseline``, as messages. Compile times are too noisy to gate
+    on and are left out.
+    """
+    old = dict(((r['kernel'], r['dtype']), r) for r in baseline['results'])
+    regressions = []
+    for result in results['results']:
+        base = old.get((result['kernel'], result['dtype']))
+        if base is None:
+            continue
+        name = '%s[%s]' % (result['kernel'], result['dtype'])
+        timings = [('call', base['call'], result['call'])]
+        base_sizes = dict((row['size'], row) for row in base['sizes'])
+        for row in result['sizes']:
+            if row['size'] in base_sizes:
+                timings.append(('size %d' % row['size'], base_sizes[row['size']]['numpile'],
+                                row['numpile']))
+        for (label, before, after) in timings:
+            if after > before * (1 + tolerance):
+                regressions.append('%s %s: %.3g s -> %.3g s (%+.0f%%)'
+                                   % (name, label, before, after, (after / before - 1) * 100))
+    return regressions
+
+
+def report(results, file=sys.stdout):
+    for result in results['results']:
+        print('%s[%s]  compile %.1f ms (%s)  first call %.1f ms  call %.2f us  dispatch %.2f us'
+              % (result['kernel'], result['dtype'], result['compile'] * 1e3, result['source'],
+                 result['first_call'] * 1e3, result['call'] * 1e6, result['dispatch'] * 1e6),
+              file=file)
+        for row in result['sizes']:
+            python = '%10.1f us' % (row['python'] * 1e6) if row['python'] is not None else ' ' * 13
+            print('  %9d  numpile %10.1f us  numpy %10.1f us  python %s  %8.1f Melem/s%s'
+                  % (row['elements'], row['numpile'] * 1e6, row['numpy'] * 1e6, python,
+                     row['throughput'] / 1e6, '' if row['ok'] else '  WRONG RESULT'),
+                  file=file)
+    for (name, rows) in results.get('micro', {}).items():
+        print(name, file=file)
+        for row in rows:
+            print('  ' + '  '.join('%s %s' % (k, round(v, 6) if isinstance(v, float) else v)
+                                   for (k, v) in row.items()), file=file)
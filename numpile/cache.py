@@ -0,0 +1,274 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import llvmlite.binding as llvm
+
+
+def source_hash(source):
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+_compiler_hash = None
+
+
+def compiler_hash():
+    """
+    A hash of numpile's own modules. Code they emit may change with any of
+    them, e.g. its calling convention, so objects cached by another version
+    must never be loaded.
+    """
+    global _compiler_hash
+    if _compiler_hash is None:
+        h = hashlib.sha256()
+        package = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                with open(os.path.join(package, name), 'rb') as f:
+                    h.update(f.read())
+        _compiler_hash = h.hexdigest()
+    return _compiler_hash
+
+
+def specialization_key(source, argtys, *extra):
+    """
+    A stable key for one specialization of a kernel. Unlike ``hash()`` this
+    does not change between processes, so it can name objects on disk.
+    """
+    h = hashlib.sha256()
+    parts = [
+        source_hash(source),
+        compiler_hash(),
+        ','.join(map(str, argtys)),
+        '.'.join(map(str, llvm.llvm_version_info)),
+        llvm.get_process_triple(),
+        llvm.get_host_cpu_name(),
+        llvm.get_host_cpu_features().flatten(),
+    ]
+    parts += list(map(str, extra))
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ObjectCache(object):
+    """
+    Stores finalized object code produced by MCJIT in a directory, keyed by
+    ``specialization_key``. LLVM modules are tagged with their key through
+    the module name, which is what the engine hooks see.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        # Size of the object code of every module the engine compiles or
+        # loads, by module name, until ``code_size`` claims it.
+        self.sizes = {}
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def install(self, engine):
+        engine.set_object_cache(self.notify, self.getbuffer)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.o')
+
+    def contains(self, key):
+        return self.enabled and os.path.exists(self.filename(key))
+
+    def load(self, key):
+        if not self.enabled:
+            return None
+        try:
+            with open(self.filename(key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def store(self, key, buf):
+        if not self.enabled:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        # Write then rename so concurrent workers never see a partial object.
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf)
+            os.replace(tmp, self.filename(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def code_size(self, name):
+        return self.sizes.pop(name, 0)
+
+    def notify(self, module, buf):
+        self.sizes[module.name] = len(buf)
+        if is_cache_key(module.name):
+            self.store(module.name, buf)
+
+    def getbuffer(self, module):
+        if is_cache_key(module.name):
+            buf = self.load(module.name)
+            if buf is not None:
+                self.sizes[module.name] = len(buf)
+            return buf
+        return None
+
+
+class FunctionCache(object):
+    """
+    The specializations resident in the engine, by ``specialization_key``,
+    least recently used first. Past ``max_entries`` specializations or
+    ``max_bytes`` of object code the coldest ones are evicted: their module
+    is handed to ``release`` and their ``on_evict`` callbacks drop every
+    other reference to their code. Both limits default to unbounded.
+
+    Calls made under ``pinned`` pin the module they run: one evicted
+    meanwhile is only released once the last of them returns.
+    """
+
+    def __init__(self, release, max_entries=None, max_bytes=None):
+        self.release = release
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.code_size = 0
+        self.lock = threading.RLock()
+        # Calls in flight per module, and the evicted modules they pin.
+        self.running = Counter()
+        self.retired = set()
+
+    @property
+    def bounded(self):
+        return self.max_entries is not None or self.max_bytes is not None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, on_evict=None):
+        """
+        The specialization under ``key`` or None. A new holder of it passes
+        its own ``on_evict``, to hear when the code goes away.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            if on_evict is not None and on_evict not in entry['on_evict']:
+                entry['on_evict'].append(on_evict)
+            return entry['pyfunc']
+
+    @contextmanager
+    def pinned(self, key):
+        """
+        Mark the specialization under ``key`` as recently used and keep its
+        module from being released while the block runs it. Gives False,
+        and pins nothing, if the key was evicted since it was looked up.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                module = entry['module']
+                self.running[module] += 1
+        if entry is None:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.leave(module)
+
+    def leave(self, module):
+        with self.lock:
+            self.running[module] -= 1
+            if self.running[module]:
+                return
+            del self.running[module]
+            if module not in self.retired:
+                return
+            self.retired.discard(module)
+        self.release(module)
+
+    def put(self, key, pyfunc, module=None, size=0, owner=None, owner_limit=None,
+            on_evict=None):
+        """
+        Add a specialization. ``owner_limit`` caps how many entries with
+        the same ``owner``, i.e. one kernel, stay resident.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.evict(key)
+            self.entries[key] = dict(pyfunc=pyfunc, module=module, size=size, owner=owner,
+                                     on_evict=[on_evict] if on_evict else [])
+            self.code_size += size
+            if owner_limit is not None:
+                assert owner_limit >= 1
+                owned = [k for (k, e) in self.entries.items() if e['owner'] is owner]
+                for k in owned[:-owner_limit]:
+                    self.evict(k)
+            self.trim()
+
+    def trim(self):
+        with self.lock:
+            # The newest entry always stays, its caller is about to run it.
+            while len(self.entries) > 1 and (
+                    (self.max_entries is not None and len(self.entries) > self.max_entries)
+                    or (self.max_bytes is not None and self.code_size > self.max_bytes)):
+                self.evict(next(iter(self.entries)))
+
+    def set_limits(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.trim()
+
+    def evict(self, key):
+        with self.lock:
+            entry = self.entries.pop(key)
+            self.code_size -= entry['size']
+        for on_evict in entry['on_evict']:
+            on_evict(key, entry['pyfunc'])
+        # Specializations compiled together share a module, it goes with
+        # the last of them.
+        module = entry['module']
+        with self.lock:
+            shared = any(e['module'] is module for e in self.entries.values())
+            busy = module in self.running
+            if busy and not shared:
+                self.retired.add(module)
+        if module is not None and not shared and not busy:
+            self.release(module)
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.evict(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.evict(key)
+
+
+def is_cache_key(name):
+    return len(name) == 64 and all(c in '0123456789abcdef' for c in name)
+
+
+def default_cache_dir():
+    return os.environ.get('NUMPILE_CACHE_DIR')
+
+
+def default_cache_limits():
+    limits = [os.environ.get('NUMPILE_CACHE_MAX_ENTRIES'),
+              os.environ.get('NUMPILE_CACHE_MAX_BYTES')]
+    return [int(limit) if limit else None for limit in limits]
@@ -1,17 +1,32 @@
+import ast
 from collections import defaultdict
 import llvmlite.llvmpy.core as ll_core
 from numpy import long
 
-from numpile import module
-from numpile.lang import TVar, is_array, Var
-from numpile.pytypes import to_lltype, double_type, bool_type, void_type, int_type
-from numpile.transformer import mangler
+from numpile import target
+from numpile.lang import is_array, Var, Prim, Loop
+from numpile.pytypes import to_lltype, double_type, float_type, bool_type, void_type, int_type, \
+    intp_type, pyarray_ptr, status_ptr
+from numpile.solve import apply
+from numpile.reduction import parallel_loop, find_reductions, identities
+from numpile.transformer import FLOAT_FLOOR_ZERO_DIVISION, FLOAT_ZERO_DIVISION, ZERO_DIVISION, \
+    array_ranks, driver_type, entry_name, entry_type, function_type, mangler, may_fail, \
+    trailing_args, variant_name
+
+# Builder methods for integer and float operands, and comparison operators.
+arith_ops = {"add#": ("add", "fadd"), "sub#": ("sub", "fsub"), "mult#": ("mul", "fmul"),
+             "div#": (None, "fdiv"), "floordiv#": (None, None)}
+compare_ops = {"lt#": '<', "le#": '<=', "gt#": '>', "ge#": '>=', "eq#": '==', "ne#": '!='}
 
 
 class LLVMEmitter(object):
-    def __init__(self, spec_types, retty, argtys):
+    def __init__(self, spec_types, retty, argtys, module=None,
+                 reassoc=False, accumulators=4, noalias=True, functions=None, local=False,
+                 fastmath=()):
+        self.module = module             # LLVM Module
         self.block = None
         self.function = None             # LLVM Function
+        self.entry = None                # Its entry point for Python
         self.builder = None              # LLVM Builder
         self.locals = {}                 # Local variables
         self.arrays = defaultdict(dict)  # Array metadata
@@ -19,6 +34,17 @@ class LLVMEmitter(object):
         self.spec_types = spec_types     # Type specialization
         self.retty = retty               # Return type
         self.argtys = argtys             # Argument types
+        self.chunk = None                # prange chunk index and count
+        self.nchunks = None
+        self.status = None               # Status pointer, if it can fail
+        self.fastmath = list(fastmath)   # Flags on float instructions
+        # May reorder float reductions
+        self.reassoc = reassoc or 'fast' in fastmath or 'reassoc' in fastmath
+        self.accumulators = accumulators # Partial results per reduction
+        self.noalias = noalias           # Array arguments don't overlap
+        self.scopes = {}                 # Alias scope metadata per array
+        self.functions = functions or {} # Kernels callable by name
+        self.local = local               # Only called from this module
 
     def start_function(self, name, module, rettype, argtypes):
         func_type = ll_core.Type.function(rettype, argtypes, False)
@@ -29,6 +55,12 @@ class LLVMEmitter(object):
         self.function = function
         self.builder = builder
 
+    def alloca(self, ty, name=''):
+        # Locals are all allocated in the entry block, the only place mem2reg
+        # and SROA promote them to registers from.
+        with self.builder.goto_entry_block():
+            return self.builder.alloca(ty, name=name)
+
     def end_function(self):
         self.builder.position_at_end(self.exit_block)
 
@@ -52,14 +84,11 @@ class LLVMEmitter(object):
         self.builder.branch(next_block)
 
     def specialize(self, val):
-        if isinstance(val.type, TVar):
-            return to_lltype(self.spec_types[val.type.s])
-        else:
-            return val.type
+        return to_lltype(apply(self.spec_types, val.type))
 
-    def const(self, val):
+    def const(self, val, ty=int_type):
         if isinstance(val, (int, long)):
-            return ll_core.Constant.int(int_type, val)
+            return ll_core.Constant.int(ty, val)
         elif isinstance(val, float):
             return ll_core.Constant.real(double_type, val)
         elif isinstance(val, bool):
@@ -71,107 +100,277 @@ class LLVMEmitter(object):
 
     def visit_LitInt(self, node):
         ty = self.specialize(node)
-        if ty is type(double_type):
-            return ll_core.Constant.real(double_type, node.n)
-        elif ty == type(int_type):
-            return ll_core.Constant.int(int_type, node.n)
+        if ty in (double_type, float_type):
+            return ll_core.Constant.real(ty, node.n)
+        elif isinstance(ty, type(int_type)):
+            return ll_core.Constant.int(ty, node.n)
         else:
             raise NotImplementedError
 
     def visit_LitFloat(self, node):
         ty = self.specialize(node)
-        if ty is type(double_type):
-            return ll_core.Constant.real(double_type, node.n)
-        elif ty == type(int_type):
-            return ll_core.Constant.int(int_type, node.n)
+        if ty in (double_type, float_type):
+            return ll_core.Constant.real(ty, node.n)
+        elif isinstance(ty, type(int_type)):
+            return ll_core.Constant.int(ty, node.n)
         else:
             raise NotImplementedError
 
+    def visit_LitBool(self, node):
+        return ll_core.Constant.int(bool_type, int(node.n))
+
     def visit_Noop(self, node):
         pass
 
     def visit_Fun(self, node):
-        rettype = to_lltype(self.retty)
-        argtypes = list(map(to_lltype, self.argtys))
+        # Each call of a prange kernel runs one chunk of the loop.
+        parallel = parallel_loop(node) is not None
+        checked = may_fail(node, self.functions)
+        extra = trailing_args(parallel, checked)
+        ranks = array_ranks(node, self.functions)
+        fnty = function_type(self.argtys, self.retty, extra, ranks)
         # Create a unique specialized name
-        func_name = mangler(node.fname, self.argtys)
-        self.start_function(func_name, module, rettype, argtypes)
-
-        for (ar, llarg, argty) in zip(node.args, self.function.args, self.argtys):
+        func_name = local_name(node.fname, self.argtys, self.noalias, self.local)
+        if self.module is None:
+            # One module per specialization, so each is cached and evicted on its own.
+            self.module = ll_core.Module('numpile.' + func_name)
+        self.start_function(func_name, self.module, fnty.return_type, list(fnty.args))
+        trailing = self.function.args[len(self.function.args) - len(extra):]
+        if parallel:
+            self.chunk, self.nchunks = trailing[:2]
+            self.chunk.name = 'chunk'
+            self.nchunks.name = 'nchunks'
+        if checked:
+            self.status = trailing[-1]
+            self.status.name = 'status'
+
+        params = iter(self.function.args)
+        for (ar, argty, rank) in zip(node.args, self.argtys, ranks):
             name = ar.id
+            llarg = next(params)
             llarg.name = name
-            # TODO: Fix name here
 
             if is_array(argty):
-                zero = self.const(0)
-                one = self.const(1)
-                two = self.const(2)
-
-                data = self.builder.gep(llarg, [
-                                        zero, zero], name=(name + '_data'))
-                dims = self.builder.gep(llarg, [
-                                        zero, one], name=(name + '_dims'))
-                shape = self.builder.gep(llarg, [
-                                         zero, two], name=(name + '_strides'))
-
-                self.arrays[name]['data'] = self.builder.load(data)
-                self.arrays[name]['dims'] = self.builder.load(dims)
-                self.arrays[name]['shape'] = self.builder.load(shape)
+                shape = [next(params) for _ in range(rank)]
+                strides = [next(params) for _ in range(rank)]
+                for (k, (extent, stride)) in enumerate(zip(shape, strides)):
+                    extent.name = '%s.shape%d' % (name, k)
+                    stride.name = '%s.stride%d' % (name, k)
+                self.arrays[name]['data'] = llarg
+                self.arrays[name]['shape'] = shape
+                self.arrays[name]['strides'] = strides
                 self.locals[name] = llarg
+                attrs = ('noalias', 'nocapture', 'nonnull') if self.noalias else ('nocapture',)
+                for attr in attrs:
+                    llarg.add_attribute(attr)
             else:
-                argref = self.builder.alloca(to_lltype(argty))
+                argref = self.alloca(to_lltype(argty), name=name + '.addr')
                 self.builder.store(llarg, argref)
                 self.locals[name] = argref
 
+        if self.noalias:
+            self.alias_scopes(func_name)
+
         # Setup the register for return type.
-        if rettype is not void_type:
-            retref = self.builder.alloca(rettype, size = 32, name = "retval")
+        if fnty.return_type != void_type:
+            retref = self.alloca(fnty.return_type, name="retval")
             self.locals['retval'] = retref
 
         list(map(self.visit, node.body))
+        if not self.builder.block.is_terminated:
+            # Falling off the end of a kernel returns.
+            self.builder.branch(self.exit_block)
         self.end_function()
+        if self.local:
+            # Internal, so the optimizer is free to inline it and drop it.
+            self.function.linkage = 'internal'
+        elif any(map(is_array, self.argtys)):
+            self.entry = self.emit_entry(node, ranks, extra)
+        else:
+            self.entry = self.function
+
+    def emit_entry(self, node, ranks, extra):
+        # What Python calls: a wrapper taking arrays as ndarray objects that
+        # reads their data pointer, extents and strides into the kernel's
+        # arguments. It is small enough for the kernel to be inlined into.
+        fnty = entry_type(self.argtys, self.retty, extra)
+        entry = ll_core.Function.new(self.module, fnty, entry_name(self.function.name, self.argtys))
+        builder = ll_core.Builder(entry.append_basic_block("entry"))
+        zero = self.const(0)
+        args = []
+        for (ar, param, argty, rank) in zip(node.args, entry.args, self.argtys, ranks):
+            param.name = ar.id
+            if not is_array(argty):
+                args.append(param)
+                continue
+            header = builder.bitcast(param, pyarray_ptr)
+            data = builder.load(builder.gep(header, [zero, self.const(2)]))
+            shape = builder.load(builder.gep(header, [zero, self.const(4)]))
+            strides = builder.load(builder.gep(header, [zero, self.const(5)]))
+            args.append(builder.bitcast(data, to_lltype(argty)))
+            args += [builder.load(builder.gep(shape, [self.const(k)])) for k in range(rank)]
+            args += [builder.load(builder.gep(strides, [self.const(k)])) for k in range(rank)]
+        args += entry.args[len(self.argtys):]
+        result = builder.call(self.function, args)
+        if fnty.return_type == void_type:
+            builder.ret_void()
+        else:
+            builder.ret(result)
+        return entry
+
+    def visit_App(self, node):
+        kernel = self.functions[node.fn.id]
+        argtys = list(apply(self.spec_types, node.type).argtys)
+        arrays = [arg.id for (arg, argty) in zip(node.args, argtys) if is_array(argty)]
+        # Arrays passed twice may overlap inside the callee.
+        noalias = self.noalias and len(set(arrays)) == len(arrays)
+        fn = self.callee(kernel, argtys, noalias)
+        args = []
+        for (arg, argty, rank) in zip(node.args, argtys, kernel.ranks):
+            if is_array(argty):
+                array = self.arrays[arg.id]
+                args += [array['data']] + array['shape'][:rank] + array['strides'][:rank]
+            else:
+                args.append(self.visit(arg))
+        if kernel.parallel:
+            # A prange loop in the callee runs whole.
+            args += [self.const(0, intp_type), self.const(1, intp_type)]
+        if kernel.checked:
+            args.append(self.status)
+        result = self.builder.call(fn, args)
+        if kernel.checked:
+            # Its failure is this kernel's.
+            failed = self.builder.icmp_signed('!=', self.builder.load(self.status), self.const(0))
+            self.branch_if(failed, self.exit_block, "call.ok")
+        return result
+
+    def branch_if(self, cond, target, name):
+        # Leave for ``target`` when ``cond`` holds, else carry on in a new block.
+        block = self.add_block(name)
+        self.cbranch(cond, target, block)
+        self.set_block(block)
+
+    def fail(self, cond, status, name):
+        # Set the status word and return early when ``cond`` holds.
+        block = self.add_block(name + ".fail")
+        self.branch_if(cond, block, name + ".ok")
+        current = self.builder.block
+        self.builder.position_at_end(block)
+        self.builder.store(self.const(status), self.status)
+        self.builder.branch(self.exit_block)
+        self.builder.position_at_end(current)
+
+    def callee(self, kernel, argtys, noalias):
+        # The callee specialized for ``argtys``, emitted into this module
+        # once per specialization.
+        try:
+            return self.module.get_global(local_name(kernel.ast.fname, argtys, noalias, True))
+        except KeyError:
+            pass
+        specializer, retty, argtys = kernel.unify(argtys)
+        cgen = LLVMEmitter(specializer, retty, argtys, self.module, noalias=noalias,
+                           functions=kernel.functions, local=True, **kernel.codegen_options)
+        cgen.visit(kernel.ast)
+        return cgen.function
 
     def visit_Index(self, node):
+        if isinstance(node.val, Prim) and node.val.fn == "shape#":
+            return self.arrays[node.val.args[0].id]['shape'][node.ix[0].n]
         if isinstance(node.val, Var) and node.val.id in self.arrays:
-            val = self.visit(node.val)
-            ix = self.visit(node.ix)
-            dataptr = self.arrays[node.val.id]['data']
-            ret = self.builder.gep(dataptr, [ix])
-            return self.builder.load(ret)
+            ixs = list(map(self.visit, node.ix))
+            ret = self.element_pointer(node.val.id, ixs)
+            return self.access(node.val.id, self.builder.load(ret, align=self.alignment(ret)))
         else:
             val = self.visit(node.val)
-            ix = self.visit(node.ix)
+            ix = self.visit(node.ix[0])
             ret = self.builder.gep(val, [ix])
             return self.builder.load(ret)
 
+    def alignment(self, ptr):
+        # NumPy aligns elements to their own size.
+        return ptr.type.pointee.get_abi_size(target.target_data)
+
+    def alias_scopes(self, func_name):
+        # One scope per array argument: accesses to an array are known not
+        # to touch any other array, which is what lets LLVM vectorize loops
+        # that store to one array while loading from another.
+        domain = self.module.add_metadata([func_name])
+        scopes = dict((name, self.module.add_metadata([func_name + '.' + name, domain]))
+                      for name in self.arrays)
+        for name in self.arrays:
+            others = [scope for (other, scope) in scopes.items() if other != name]
+            self.scopes[name] = (self.module.add_metadata([scopes[name]]),
+                                 self.module.add_metadata(others))
+
+    def access(self, name, inst):
+        if name in self.scopes and len(self.scopes) > 1:
+            scope, noalias = self.scopes[name]
+            inst.set_metadata('alias.scope', scope)
+            inst.set_metadata('noalias', noalias)
+        return inst
+
+    def element_pointer(self, name, ixs):
+        # Address of a[i, j, ...] is data + i*strides[0] + j*strides[1] + ...
+        # which covers views and either memory order without a copy. Strides
+        # come in bytes but are scaled to elements, arrays being aligned, so
+        # the vectorizer can version loops on a unit stride.
+        array = self.arrays[name]
+        itemsize = self.const(self.alignment(array['data']), intp_type)
+        offset = None
+        for (k, ix) in enumerate(ixs):
+            stride = self.builder.sdiv(array['strides'][k], itemsize)
+            term = self.builder.mul(ix, stride)
+            offset = term if offset is None else self.builder.add(offset, term)
+        return self.builder.gep(array['data'], [offset])
+
     def visit_Var(self, node):
         return self.builder.load(self.locals[node.id])
 
     def visit_Return(self, node):
-        val = self.visit(node.val)
-        if val.type != void_type:
-            self.builder.store(val, self.locals['retval'])
+        if node.val is not None:
+            val = self.visit(node.val)
+            if val.type != void_type:
+                self.builder.store(val, self.locals['retval'])
         self.builder.branch(self.exit_block)
 
+    def visit_Store(self, node):
+        val = self.visit(node.val)
+        ixs = list(map(self.visit, node.ix))
+        ptr = self.element_pointer(node.ref.id, ixs)
+        self.access(node.ref.id, self.builder.store(val, ptr, align=self.alignment(ptr)))
+
     def visit_Loop(self, node):
         init_block = self.function.append_basic_block('for.init')
-        test_block = self.function.append_basic_block('for.cond')
-        body_block = self.function.append_basic_block('for.body')
-        end_block = self.function.append_basic_block("for.end")
 
         self.branch(init_block)
         self.set_block(init_block)
 
         start = self.visit(node.begin)
         stop = self.visit(node.end)
-        step = 1
+        if node.parallel:
+            start, stop = self.chunk_bounds(start, stop)
+            self.reset_reductions(node)
 
         # Setup the increment variable
         varname = node.var.id
-        inc = self.builder.alloca(int_type, varname)
+        inc = self.alloca(intp_type, name=varname)
         self.builder.store(start, inc)
         self.locals[varname] = inc
 
+        # Independent accumulators for the bulk of the iterations, the
+        # remainder runs on the original ones.
+        reductions = self.split_reductions(node)
+        if reductions:
+            accs = self.emit_split_loop(node, inc, stop, reductions)
+        self.emit_loop(node, inc, stop)
+        if reductions:
+            self.combine_accumulators(reductions, accs)
+
+    def emit_loop(self, node, inc, stop, step=1):
+        test_block = self.function.append_basic_block('for.cond')
+        body_block = self.function.append_basic_block('for.body')
+        end_block = self.function.append_basic_block("for.end")
+
         # Setup the loop condition
         self.branch(test_block)
         self.set_block(test_block)
@@ -183,34 +382,231 @@ class LLVMEmitter(object):
         list(map(self.visit, node.body))
 
         # Increment the counter
-        succ = self.builder.add(self.const(step), self.builder.load(inc))
+        succ = self.builder.add(self.const(step, intp_type), self.builder.load(inc))
         self.builder.store(succ, inc)
 
         # Exit the loop
         self.builder.branch(test_block)
         self.set_block(end_block)
 
+    def split_reductions(self, node):
+        # Integer reductions are exact in any order; floating point ones only
+        # when the kernel allows reassociation. Only innermost loops split,
+        # splitting at every level of a nest would copy the body
+        # ``accumulators`` times per level; this also means an accumulator
+        # is never split again by an inner loop.
+        if self.accumulators < 2:
+            return {}
+        if any(isinstance(n, Loop) for stmt in node.body for n in ast.walk(stmt)):
+            return {}
+        reductions = find_reductions(node, self.locals)
+        return dict((name, op) for (name, op) in reductions.items()
+                    if self.reassoc or self.locals[name].type.pointee not in (double_type, float_type))
+
+    def emit_split_loop(self, node, inc, stop, reductions):
+        # Unroll by the number of accumulators and give every copy of the
+        # body its own, so the copies have no dependency on each other.
+        k = self.accumulators
+        varname = node.var.id
+        accs = {}
+        for (name, op) in reductions.items():
+            var = self.locals[name]
+            accs[name] = [var]
+            for n in range(1, k):
+                acc = self.alloca(var.type.pointee, name=name + '.acc')
+                self.builder.store(self.identity(var.type.pointee, op), acc)
+                accs[name].append(acc)
+        ivar = self.alloca(intp_type, name=varname + '.split')
+
+        test_block = self.function.append_basic_block('for.split.cond')
+        body_block = self.function.append_basic_block('for.split.body')
+        end_block = self.function.append_basic_block("for.split.end")
+
+        self.branch(test_block)
+        self.set_block(test_block)
+        last = self.builder.add(self.builder.load(inc), self.const(k - 1, intp_type))
+        cond = self.builder.icmp(ll_core.ICMP_SLT, last, stop)
+        self.builder.cbranch(cond, body_block, end_block)
+
+        self.set_block(body_block)
+        i = self.builder.load(inc)
+        self.locals[varname] = ivar
+        for n in range(k):
+            self.builder.store(self.builder.add(i, self.const(n, intp_type)), ivar)
+            for name in reductions:
+                self.locals[name] = accs[name][n]
+            list(map(self.visit, node.body))
+        self.locals[varname] = inc
+        for name in reductions:
+            self.locals[name] = accs[name][0]
+
+        succ = self.builder.add(self.const(k, intp_type), self.builder.load(inc))
+        self.builder.store(succ, inc)
+        self.builder.branch(test_block)
+        self.set_block(end_block)
+        return accs
+
+    def combine_accumulators(self, reductions, accs):
+        # Pairwise, so the combine itself is a tree rather than a chain.
+        for (name, op) in reductions.items():
+            vals = [self.builder.load(acc) for acc in accs[name]]
+            while len(vals) > 1:
+                pairs = [vals[n:n+2] for n in range(0, len(vals), 2)]
+                vals = [self.arith(op, *pair) if len(pair) == 2 else pair[0]
+                        for pair in pairs]
+            self.builder.store(vals[0], accs[name][0])
+
+    def identity(self, ty, op):
+        if ty in (double_type, float_type):
+            return ll_core.Constant.real(ty, identities[op])
+        else:
+            return ll_core.Constant.int(ty, identities[op])
+
+    def chunk_bounds(self, start, stop):
+        # Chunk k of n covers [start + total*k/n, start + total*(k+1)/n).
+        total = self.builder.sub(stop, start)
+        succ = self.builder.add(self.chunk, self.const(1, intp_type))
+        lo = self.builder.sdiv(self.builder.mul(total, self.chunk), self.nchunks)
+        hi = self.builder.sdiv(self.builder.mul(total, succ), self.nchunks)
+        return self.builder.add(start, lo), self.builder.add(start, hi)
+
+    def reset_reductions(self, node):
+        # Only the first chunk starts from the accumulator's initial value,
+        # the others start from the identity and are combined afterwards.
+        first = self.builder.icmp(ll_core.ICMP_EQ, self.chunk, self.const(0, intp_type))
+        for (name, op) in find_reductions(node, self.locals).items():
+            var = self.locals[name]
+            identity = self.identity(var.type.pointee, op)
+            init = self.builder.select(first, self.builder.load(var), identity)
+            self.builder.store(init, var)
+
     def visit_Prim(self, node):
         if node.fn == "shape#":
-            ref = node.args[0]
-            shape = self.arrays[ref.id]['shape']
-            return shape
-        elif node.fn == "mult#":
-            a = self.visit(node.args[0])
-            b = self.visit(node.args[1])
-            if a.type == double_type:
-                return self.builder.fmul(a, b)
-            else:
-                return self.builder.mul(a, b)
-        elif node.fn == "add#":
-            a = self.visit(node.args[0])
-            b = self.visit(node.args[1])
-            if a.type == double_type:
-                return self.builder.fadd(a, b)
-            else:
-                return self.builder.add(a, b)
-        else:
+            # Only reachable indexed, through visit_Index.
             raise NotImplementedError
+        elif node.fn == "select#":
+            return self.select(*node.args)
+        args = [self.visit(arg) for arg in node.args]
+        if node.fn in arith_ops:
+            return self.arith(node.fn, *args)
+        elif node.fn in compare_ops:
+            return self.compare(node.fn, *args)
+        else:
+            return self.builtin(node.fn, args)
+
+    def arith(self, fn, a, b):
+        floating = a.type in (double_type, float_type)
+        if fn == "div#" and not floating:
+            raise NotImplementedError("/ needs floats, use // for integers")
+        elif fn == "div#":
+            self.fail(self.is_zero(b), FLOAT_ZERO_DIVISION, "div")
+        elif fn == "floordiv#" and floating:
+            return self.float_floordiv(a, b)
+        elif fn == "floordiv#":
+            return self.floordiv(a, b)
+        inst = getattr(self.builder, arith_ops[fn][floating])(a, b)
+        if floating:
+            inst.flags.extend(self.fastmath)
+        return inst
+
+    def floordiv(self, a, b):
+        # sdiv truncates towards zero where Python floors: one less when
+        # the remainder is nonzero and its sign differs from the divisor's.
+        # Both trap on a zero divisor, which fails the call instead, and on
+        # the minimum divided by -1, which wraps around instead like other
+        # integer overflow.
+        zero = ll_core.Constant.int(a.type, 0)
+        one = ll_core.Constant.int(a.type, 1)
+        self.fail(self.builder.icmp_signed('==', b, zero), ZERO_DIVISION, "div")
+        minus_one = self.builder.icmp_signed('==', b, ll_core.Constant.int(a.type, -1))
+        b = self.builder.select(minus_one, one, b)
+        rem = self.builder.srem(a, b)
+        adjust = self.builder.and_(self.builder.icmp_signed('!=', rem, zero),
+                                   self.builder.icmp_signed('<', self.builder.xor(rem, b), zero))
+        quotient = self.builder.sub(self.builder.sdiv(a, b), self.builder.zext(adjust, a.type))
+        return self.builder.select(minus_one, self.builder.neg(a), quotient)
+
+    def is_zero(self, b):
+        return self.builder.fcmp_ordered('==', b, ll_core.Constant.real(b.type, 0.0))
+
+    def float_floordiv(self, a, b):
+        # As Python does it: floor(a / b) can round up across an integer,
+        # (a - fmod(a, b)) / b is the exact quotient up to one less when the
+        # remainder's sign differs from the divisor's, then floored and
+        # snapped to the nearest integer.
+        self.fail(self.is_zero(b), FLOAT_FLOOR_ZERO_DIVISION, "floordiv")
+        builder = self.builder
+        zero = ll_core.Constant.real(a.type, 0.0)
+        one = ll_core.Constant.real(a.type, 1.0)
+        mod = builder.frem(a, b)
+        div = builder.fdiv(builder.fsub(a, mod), b)
+        adjust = builder.and_(builder.fcmp_unordered('!=', mod, zero),
+                              builder.xor(builder.fcmp_ordered('<', b, zero),
+                                          builder.fcmp_ordered('<', mod, zero)))
+        div = builder.select(adjust, builder.fsub(div, one), div)
+        floor = self.intrinsic('llvm.floor', [div])
+        snap = builder.fcmp_ordered('>', builder.fsub(div, floor), ll_core.Constant.real(a.type, 0.5))
+        floor = builder.select(snap, builder.fadd(floor, one), floor)
+        # A zero quotient takes the sign of the true one.
+        signed_zero = self.intrinsic('llvm.copysign', [zero, builder.fdiv(a, b)])
+        return builder.select(builder.fcmp_unordered('!=', div, zero), floor, signed_zero)
+
+    def compare(self, fn, a, b):
+        op = compare_ops[fn]
+        if a.type not in (double_type, float_type):
+            return self.builder.icmp_signed(op, a, b)
+        # As in Python a comparison with NaN is false, except !=.
+        if op == '!=':
+            return self.builder.fcmp_unordered(op, a, b, flags=self.fastmath)
+        return self.builder.fcmp_ordered(op, a, b, flags=self.fastmath)
+
+    def select(self, test, body, orelse):
+        # Only the chosen side is evaluated, as in Python. Cheap sides are
+        # turned back into a select by the optimizer, which vectorizes.
+        then_block = self.add_block("if.then")
+        else_block = self.add_block("if.else")
+        end_block = self.add_block("if.end")
+        self.cbranch(self.visit(test), then_block, else_block)
+        self.set_block(then_block)
+        a = self.visit(body)
+        then_end = self.builder.block
+        self.branch(end_block)
+        self.set_block(else_block)
+        b = self.visit(orelse)
+        else_end = self.builder.block
+        self.branch(end_block)
+        self.set_block(end_block)
+        phi = self.builder.phi(a.type)
+        phi.add_incoming(a, then_end)
+        phi.add_incoming(b, else_end)
+        return phi
+
+    def builtin(self, fn, args):
+        a = args[0]
+        floating = a.type in (double_type, float_type)
+        if fn == "neg#":
+            return self.builder.fneg(a, flags=self.fastmath) if floating else self.builder.neg(a)
+        elif fn == "abs#" and floating:
+            return self.intrinsic('llvm.fabs', args)
+        elif fn == "abs#":
+            return self.builder.select(self.compare("lt#", a, ll_core.Constant.int(a.type, 0)),
+                                       self.builder.neg(a), a)
+        elif fn in ("min#", "max#"):
+            # As Python's: the first argument unless the second is smaller
+            # (larger), so NaNs propagate the same way.
+            b = args[1]
+            smaller = self.compare("lt#" if fn == "min#" else "gt#", b, a)
+            return self.builder.select(smaller, b, a, flags=self.fastmath if floating else ())
+        elif not floating:
+            raise NotImplementedError("math.%s needs floats" % fn[:-1])
+        else:
+            return self.intrinsic('llvm.' + fn[:-1], args)
+
+    def intrinsic(self, name, args):
+        ty = args[0].type
+        fnty = ll_core.Type.function(ty, [ty] * len(args))
+        fn = self.module.declare_intrinsic(name, [ty], fnty)
+        return self.builder.call(fn, args, fastmath=self.fastmath)
 
     def visit_Assign(self, node):
         # Subsequent assignment
@@ -227,7 +623,7 @@ class LLVMEmitter(object):
             name = node.ref
             val = self.visit(node.val)
             ty = self.specialize(node)
-            var = self.builder.alloca(ty, name)
+            var = self.alloca(ty, name=name)
             self.builder.store(val, var)
             self.locals[name] = var
             return var
@@ -241,3 +637,67 @@ class LLVMEmitter(object):
 
     def generic_visit(self, node):
         raise NotImplementedError
+
+
+def local_name(fname, argtys, noalias, local):
+    # Copies of a kernel emitted for its callers are named apart from it, it
+    # may be compiled into the same module.
+    name = mangler(variant_name(fname, noalias), argtys)
+    return name + '.local' if local else name
+
+
+def emit_driver(entry, argtys, retty, name):
+    """
+    Emit a loop next to the Python ``entry`` of a kernel that calls it once
+    per argument set, ``out[i] = entry(args0[i], args1[i], ...)`` for ``i``
+    below ``n``; see ``driver_type``. A prange loop runs whole, as the one
+    chunk of its set. The loop stops at the first set that fails.
+    """
+    extra = entry.args[len(argtys):]
+    checked = bool(extra) and extra[-1].type == status_ptr
+    fn = ll_core.Function.new(entry.module, driver_type(argtys, retty, checked), name)
+    n = fn.args[0]
+    columns = fn.args[1:1 + len(argtys)]
+    out = fn.args[1 + len(argtys)] if len(fn.args) > 1 + len(argtys) + checked else None
+    status = fn.args[-1] if checked else None
+
+    entry_block = fn.append_basic_block("entry")
+    cond = fn.append_basic_block("cond")
+    body = fn.append_basic_block("body")
+    latch = fn.append_basic_block("latch")
+    exit_block = fn.append_basic_block("exit")
+
+    builder = ll_core.Builder(entry_block)
+    zero = ll_core.Constant.int(intp_type, 0)
+    one = ll_core.Constant.int(intp_type, 1)
+    builder.branch(cond)
+
+    builder.position_at_end(cond)
+    i = builder.phi(intp_type, name='i')
+    builder.cbranch(builder.icmp(ll_core.ICMP_SLT, i, n), body, exit_block)
+
+    builder.position_at_end(body)
+    args = [builder.load(builder.gep(column, [i])) for column in columns]
+    if len(extra) - checked == 2:
+        args += [zero, one]
+    if checked:
+        args.append(status)
+    result = builder.call(entry, args)
+    if out is not None:
+        builder.store(result, builder.gep(out, [i]))
+    if checked:
+        failed = builder.icmp_signed('!=', builder.load(status), ll_core.Constant.int(int_type, 0))
+        builder.cbranch(failed, exit_block, latch)
+    else:
+        builder.branch(latch)
+
+    builder.position_at_end(latch)
+    i_next = builder.add(i, one)
+    builder.branch(cond)
+
+    builder.position_at_end(exit_block)
+    builder.ret_void()
+
+    i.add_incoming(zero, entry_block)
+    i.add_incoming(i_next, latch)
+    return fn
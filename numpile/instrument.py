@@ -0,0 +1,131 @@
+import threading
+import time
+import weakref
+
+# Compile times are always recorded, they are cheap next to compiling. Call
+# counts and the time spent in compiled code cost a clock read per call, so
+# they are only collected once enabled.
+enabled = False
+
+_hooks = []
+_kernels = weakref.WeakSet()
+_lock = threading.Lock()
+
+
+def enable_stats(flag=True):
+    """
+    Start (or stop) counting calls and timing them, per kernel and per
+    argument types.
+    """
+    global enabled
+    enabled = flag
+
+
+def add_stats_hook(hook):
+    """
+    Call ``hook(event, name, record)`` whenever a kernel is analysed
+    ('frontend') or a specialization is built or loaded ('specialize'), e.g.
+    to forward the timings in ``record`` to a metrics system.
+    """
+    _hooks.append(hook)
+
+
+def remove_stats_hook(hook):
+    _hooks.remove(hook)
+
+
+def notify(event, name, record):
+    for hook in list(_hooks):
+        hook(event, name, record)
+
+
+def stats():
+    """
+    The ``stats`` of every live kernel, keyed ``'name@id'`` since kernels
+    built from the same source (one per dtype, say) share a name.
+    """
+    return dict(('%s@%x' % (kernel.__name__, id(kernel)), kernel.stats)
+                for kernel in list(_kernels))
+
+
+class Timer(object):
+    """
+    Accumulates the wall time of ``with timer('phase'):`` blocks into a dict.
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.phase = None
+
+    def __call__(self, phase):
+        self.phase = phase
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.record[self.phase] = self.record.get(self.phase, 0.0) + elapsed
+
+
+def describe_key(key):
+    # A dispatch key as argument type names, e.g. 'float, float64[1d]'.
+    names = []
+    for part in key:
+        if isinstance(part, tuple):
+            names.append('%s[%dd]' % (part[1], part[2]))
+        elif isinstance(part, type):
+            names.append(part.__name__)
+        else:
+            names.append(str(part))
+    return ', '.join(names)
+
+
+class KernelStats(object):
+    """
+    What one kernel has cost so far: the frontend, every specialization it
+    compiled or loaded from a cache, and, when enabled, its calls.
+    """
+
+    def __init__(self, kernel):
+        self.frontend = {}
+        self.specializations = []
+        self.hits = 0
+        self.misses = 0
+        self.calls = {}
+        _kernels.add(kernel)
+
+    def analysed(self, name, record):
+        self.frontend = record
+        notify('frontend', name, record)
+
+    def specialized(self, name, record):
+        with _lock:
+            self.specializations.append(record)
+            if record['source'] == 'compiled':
+                self.misses += 1
+            else:
+                self.hits += 1
+        notify('specialize', name, record)
+
+    def called(self, key, elapsed, count=1):
+        with _lock:
+            entry = self.calls.get(key)
+            if entry is None:
+                entry = self.calls[key] = [0, 0.0]
+            entry[0] += count
+            entry[1] += elapsed
+
+    def snapshot(self):
+        with _lock:
+            calls = dict((describe_key(key), {'count': n, 'time': t})
+                         for (key, (n, t)) in self.calls.items())
+            return {
+                'frontend': dict(self.frontend),
+                'specializations': [dict(r) for r in self.specializations],
+                'cache': {'hits': self.hits, 'misses': self.misses},
+                'calls': calls,
+                'total_calls': sum(c['count'] for c in calls.values()),
+                'native_time': sum(c['time'] for c in calls.values()),
+            }
@@ -7,8 +7,7 @@ import ctypes
 import inspect
 import pprint
 import string
-from functools import reduce
-from typing import List
+import weakref
 
 import numpy as np
 
@@ -57,14 +56,15 @@ class Return(ast.AST):
 
 
 class Loop(ast.AST):
-    _fields = ["var", "begin", "end", "body"]
+    _fields = ["var", "begin", "end", "body", "parallel"]
 
-    def __init__(self, var, begin, end, body, *args, **kwargs):
+    def __init__(self, var, begin, end, body, parallel = False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.var = var
         self.begin = begin
         self.end = end
         self.body = body
+        self.parallel = parallel
 
 
 class App(ast.AST):
@@ -130,103 +130,116 @@ class Index(ast.AST):
         self.ix = ix
 
 
-class Noop(ast.AST):
-    _fields = []
+class Store(ast.AST):
+    _fields = ["ref", "ix", "val"]
 
+    def __init__(self, ref, ix, val, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ref = ref
+        self.ix = ix
+        self.val = val
 
-class TVar(object):
-    _fields = ["s"]
 
-    def __init__(self, s):
-        self.s = s
+class Noop(ast.AST):
+    _fields = []
 
-    def __hash__(self):
-        return hash(self.s)
 
-    def __eq__(self, other):
-        if isinstance(other, TVar):
-            return self.s == other.s
-        else:
-            return False
+class Type(object):
+    """
+    Type terms are hash-consed: constructing a term that already exists
+    returns the existing object, so equality is identity and hashing is by
+    address. Terms are immutable and cache their free variables. The intern
+    table holds them weakly, so terms nothing uses any more are dropped.
+    """
+    __slots__ = ["_ftv", "__weakref__"]
+    _fields = []
+    _interned = weakref.WeakValueDictionary()
 
-    def __str__(self):
-        return self.s
+    @classmethod
+    def intern(cls, *fields):
+        key = (cls,) + fields
+        term = Type._interned.get(key)
+        if term is None:
+            term = object.__new__(cls)
+            for (name, val) in zip(cls._fields, fields):
+                object.__setattr__(term, name, val)
+            object.__setattr__(term, '_ftv', None)
+            term = Type._interned.setdefault(key, term)
+        return term
 
-    __repr__ = __str__
+    def __setattr__(self, name, val):
+        raise AttributeError("Type terms are immutable")
 
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self._fields))
 
-class TCon(object):
-    _fields = ["s"]
+    def __repr__(self):
+        return str(self)
 
-    def __init__(self, s):
-        self.s = s
 
-    def __eq__(self, other):
-        if isinstance(other, TCon):
-            return self.s == other.s
-        else:
-            return False
+class TVar(Type):
+    __slots__ = ["s"]
+    _fields = ["s"]
 
-    def __hash__(self):
-        return hash(self.s)
+    def __new__(cls, s):
+        return cls.intern(s)
 
     def __str__(self):
         return self.s
 
-    __repr__ = __str__
 
+class TCon(Type):
+    __slots__ = ["s"]
+    _fields = ["s"]
 
-class TApp(object):
-    _fields = ["a", "b"]
+    def __new__(cls, s):
+        return cls.intern(s)
 
-    def __init__(self, a, b):
-        self.a = a
-        self.b = b
+    def __str__(self):
+        return self.s
 
-    def __eq__(self, other):
-        if isinstance(other, TApp):
-            return (self.a == other.a) & (self.b == other.b)
-        else:
-            return False
 
-    def __hash__(self):
-        return hash((self.a, self.b))
+class TApp(Type):
+    __slots__ = ["a", "b"]
+    _fields = ["a", "b"]
+
+    def __new__(cls, a, b):
+        return cls.intern(a, b)
 
     def __str__(self):
         return str(self.a) + " " + str(self.b)
 
-    __repr__ = __str__
-
 
-class TFun(object):
+class TFun(Type):
+    __slots__ = ["argtys", "retty"]
     _fields = ["argtys", "retty"]
 
-    def __init__(self, argtys: List, retty):
-        assert isinstance(argtys, list)
-        self.argtys = argtys
-        self.retty = retty
+    def __new__(cls, argtys, retty):
+        return cls.intern(tuple(argtys), retty)
 
-    def __eq__(self, other):
-        if isinstance(other, TFun):
-            return (self.argtys == other.argtys) & (self.retty == other.retty)
-        else:
-            return False
+    def __reduce__(self):
+        return (TFun, (list(self.argtys), self.retty))
 
     def __str__(self):
-        return str(self.argtys) + " -> " + str(self.retty)
+        return "[" + ", ".join(map(str, self.argtys)) + "] -> " + str(self.retty)
 
-    __repr__ = __str__
 
 def ftv(x):
-    if isinstance(x, TCon):
-        return set()
-    elif isinstance(x, TApp):
-        return ftv(x.a) | ftv(x.b)
-    elif isinstance(x, TFun):
-        # TODO: Update this to py3
-        return reduce(set.union, map(ftv, x.argtys)) | ftv(x.retty)
-    elif isinstance(x, TVar):
-        return {x}
+    """
+    The free type variables of ``x``, computed once per term.
+    """
+    vs = x._ftv
+    if vs is None:
+        if isinstance(x, TVar):
+            vs = frozenset([x])
+        elif isinstance(x, TCon):
+            vs = frozenset()
+        elif isinstance(x, TApp):
+            vs = ftv(x.a) | ftv(x.b)
+        elif isinstance(x, TFun):
+            vs = frozenset().union(*map(ftv, x.argtys)) | ftv(x.retty)
+        object.__setattr__(x, '_ftv', vs)
+    return vs
 
 
 def is_array(ty):
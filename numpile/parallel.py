@@ -0,0 +1,88 @@
+import operator
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Inside compiled kernels prange is lowered to chunked native loops; called
+# from plain Python it behaves like range.
+prange = range
+
+# With dynamic scheduling each thread gets this many chunks on average, so
+# threads that finish early pick up the work of slower ones.
+CHUNKS_PER_THREAD = 8
+
+combiners = {"add#": operator.add, "mult#": operator.mul}
+
+_num_threads = int(os.environ.get('NUMPILE_NUM_THREADS', 0)) or os.cpu_count()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def set_num_threads(n):
+    """
+    Resize the pool that runs prange chunks. Compiled code releases the GIL,
+    so this is the number of cores a parallel kernel can use.
+    """
+    global _num_threads, _pool
+    assert n >= 1
+    with _pool_lock:
+        _num_threads = n
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+
+def get_num_threads():
+    return _num_threads
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=_num_threads,
+                                       thread_name_prefix='numpile')
+        return _pool
+
+
+def num_chunks(schedule):
+    if schedule == 'static':
+        return _num_threads
+    elif schedule == 'dynamic':
+        return _num_threads * CHUNKS_PER_THREAD
+    else:
+        raise ValueError("Unknown schedule: %s" % schedule)
+
+
+def tree_reduce(fn, vals):
+    """
+    Combine ``vals`` pairwise, level by level, rather than left to right.
+    Keeps rounding error growth logarithmic for float partial sums.
+    """
+    while len(vals) > 1:
+        pairs = [vals[n:n+2] for n in range(0, len(vals), 2)]
+        vals = [fn(*pair) if len(pair) == 2 else pair[0] for pair in pairs]
+    return vals[0]
+
+
+def parallel_entry(entry, op, schedule='static'):
+    """
+    Wrap the compiled entry of a prange kernel, whose last two arguments
+    select the chunk of the loop to run, into a function that runs all the
+    chunks on the pool and combines their results with ``op``.
+    """
+    def _parallel_call(*args):
+        nchunks = num_chunks(schedule)
+        pool = get_pool()
+        futures = [pool.submit(entry, *(args + (k, nchunks)))
+                   for k in range(nchunks)]
+        # Every chunk finishes before this returns or raises, the caller
+        # keeps the code pinned only that long.
+        wait(futures)
+        partials = [f.result() for f in futures]
+        if op is None:
+            return None
+        return tree_reduce(combiners[op], partials)
+    _parallel_call.__name__ = entry.__name__
+    _parallel_call.__wrapped__ = entry
+    return _parallel_call
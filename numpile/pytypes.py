@@ -6,15 +6,18 @@ int32 = TCon("Int32")
 int64 = TCon("Int64")
 float32 = TCon("Float")
 double64 = TCon("Double")
+boolean = TCon("Bool")
 void = TCon("Void")
 array = lambda t: TApp(TCon("Array"), t)
 
 array_int32 = array(int32)
 array_int64 = array(int64)
+array_float32 = array(float32)
 array_double64 = array(double64)
 
 pointer     = Type.pointer
 int_type    = Type.int()
+intp_type   = Type.int(64)
 float_type  = Type.float()
 double_type = Type.double()
 bool_type   = Type.int(1)
@@ -22,25 +25,35 @@ void_type   = Type.void()
 void_ptr    = pointer(Type.int(8))
 struct_type = Type.struct([])
 
-def array_type(elt_type):
-    return Type.struct([
-        pointer(elt_type),  # data
-        int_type,           # dimensions
-        pointer(int_type),  # shape
-        'ndarray_' + str(elt_type), # name
-    ])
+# Compiled kernels take an array as its data pointer, followed by its extent
+# and its stride in bytes along each dimension they index.
+int32_array = pointer(int_type)
+int64_array = pointer(intp_type)
+float_array = pointer(float_type)
+double_array = pointer(double_type)
 
-int32_array = pointer(array_type(int_type))
-int64_array = pointer(array_type(Type.int(64)))
-double_array = pointer(array_type(double_type))
+# CPython's object header, ob_refcnt and ob_type, and the head of NumPy's
+# PyArrayObject_fields that follows it: data, nd, dimensions and strides.
+# Python entries of kernels take arrays as the ndarray object itself and
+# read these fields, which are part of NumPy's ABI.
+pyobject_ptr = pointer(Type.struct([intp_type, void_ptr]))
+pyarray_ptr = pointer(Type.struct([intp_type, void_ptr, void_ptr, int_type,
+                                   pointer(intp_type), pointer(intp_type)]))
+
+# Kernels that can fail at run time take a pointer to a status word last,
+# which they set to nonzero before returning early.
+status_ptr = pointer(int_type)
 
 lltypes_map = {
     int32          : int_type,
-    int64          : int_type,
+    int64          : intp_type,
     float32        : float_type,
     double64       : double_type,
+    boolean        : bool_type,
+    void           : void_type,
     array_int32    : int32_array,
     array_int64    : int64_array,
+    array_float32  : float_array,
     array_double64 : double_array
 }
 
@@ -49,5 +62,15 @@ def to_lltype(ptype):
     return lltypes_map[ptype]
 
 
+pytypes_by_name = dict((str(ty), ty) for ty in lltypes_map)
+
+
+def from_str(name):
+    """
+    Inverse of ``str`` for the concrete types in ``lltypes_map``.
+    """
+    return pytypes_by_name[name]
+
+
 def determined(ty):
     return len(ftv(ty)) == 0
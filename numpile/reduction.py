@@ -0,0 +1,99 @@
+import ast
+from collections import Counter
+
+from numpile.lang import Assign, Loop, Noop, Prim, Return, Var
+
+# Value each reduction starts from in a chunk that doesn't own the
+# accumulator's initial value.
+identities = {"add#": 0, "mult#": 1}
+
+
+def reduction_op(node):
+    """
+    The operator of an ``x = x op expr`` update, or None for any other
+    assignment.
+    """
+    val = node.val
+    if not (isinstance(val, Prim) and val.fn in identities):
+        return None
+    acc, rhs = val.args
+    if not (isinstance(acc, Var) and acc.id == node.ref):
+        return None
+    if any(isinstance(n, Var) and n.id == node.ref for n in ast.walk(rhs)):
+        return None
+    return val.fn
+
+
+def find_reductions(loop, defined):
+    """
+    Variables of ``loop`` that are only ever updated with a single
+    associative operator and never read otherwise, mapped to that operator.
+    Only names in ``defined``, i.e. live before the loop, qualify.
+    """
+    ops = {}
+    rejected = set()
+    updates = Counter()
+    for node in ast.walk(loop):
+        if isinstance(node, Assign):
+            op = reduction_op(node)
+            if op is None or ops.setdefault(node.ref, op) != op:
+                rejected.add(node.ref)
+            updates[node.ref] += 1
+    # Each update reads the accumulator once; any other read depends on the
+    # order of iterations.
+    reads = Counter(n.id for n in ast.walk(loop) if isinstance(n, Var))
+    return dict((ref, op) for (ref, op) in ops.items()
+                if ref not in rejected and ref in defined
+                and reads[ref] == updates[ref])
+
+
+def parallel_loop(fun):
+    """
+    The ``prange`` loop of ``fun``, or None. Chunks of the loop run the whole
+    function, so everything around the loop must be safe to repeat: only
+    local assignments before it and a return after it.
+    """
+    loops = [n for n in ast.walk(fun) if isinstance(n, Loop) and n.parallel]
+    if not loops:
+        return None
+    loop = loops[0]
+    if len(loops) > 1 or not any(loop is stmt for stmt in fun.body):
+        raise NotImplementedError("Only one prange loop, at the top level of "
+                                  "the function, is supported")
+
+    ix = [stmt is loop for stmt in fun.body].index(True)
+    before, after = fun.body[:ix], fun.body[ix+1:]
+    if not all(isinstance(stmt, (Assign, Noop)) for stmt in before):
+        raise NotImplementedError("Only assignments may precede a prange loop")
+    if not all(isinstance(stmt, (Return, Noop)) for stmt in after):
+        raise NotImplementedError("Only a return may follow a prange loop")
+    return loop
+
+
+def defined_before(fun, loop):
+    names = set(arg.id for arg in fun.args)
+    for stmt in fun.body:
+        if stmt is loop:
+            break
+        if isinstance(stmt, Assign):
+            names.add(stmt.ref)
+    return names
+
+
+def parallel_reduction(fun):
+    """
+    How to combine the results of the chunks of a ``prange`` kernel: the
+    operator of the reduction variable it returns, or None if it returns
+    nothing.
+    """
+    loop = parallel_loop(fun)
+    reductions = find_reductions(loop, defined_before(fun, loop))
+    returns = [stmt for stmt in fun.body
+               if isinstance(stmt, Return) and stmt.val is not None]
+    if not returns:
+        return None
+    val = returns[0].val
+    if isinstance(val, Var) and val.id in reductions:
+        return reductions[val.id]
+    raise NotImplementedError("A prange kernel must return one of its "
+                              "reduction variables")
@@ -1,5 +1,3 @@
-from collections import deque
-
 from numpile.lang import TCon, TApp, TFun, TVar, ftv
 
 
@@ -8,7 +6,12 @@ def empty():
 
 
 def apply(s, t):
-    if isinstance(t, TCon):
+    if isinstance(t, TVar):
+        return s.get(t.s, t)
+    # Terms without free variables, or none that ``s`` binds, are unchanged;
+    # returning them as is avoids rebuilding the tree.
+    vs = ftv(t)
+    if not vs or not any(v.s in s for v in vs):
         return t
     elif isinstance(t, TApp):
         return TApp(apply(s, t.a), apply(s, t.b))
@@ -16,57 +19,112 @@ def apply(s, t):
         argtys = [apply(s, a) for a in t.argtys]
         retty = apply(s, t.retty)
         return TFun(argtys, retty)
-    elif isinstance(t, TVar):
-        return s.get(t.s, t)
 
 
-def applyList(s, xs):
-    return [(apply(s, x), apply(s, y)) for (x, y) in xs]
+class Unifier(object):
+    """
+    Unification over a union-find of type variables. Each variable points at
+    another variable it was unified with, or at the type it was bound to;
+    lookups compress the paths they follow, so a long run of constraints
+    costs close to linear time instead of rewriting every substitution.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.rank = {}
+
+    def find(self, t):
+        # The representative of ``t``: an unbound variable or a non-variable
+        # type.
+        path = []
+        while isinstance(t, TVar) and t.s in self.parent:
+            path.append(t.s)
+            t = self.parent[t.s]
+        for s in path[:-1]:
+            self.parent[s] = t
+        return t
+
+    def unify(self, x, y):
+        pending = [(x, y)]
+        while pending:
+            (a, b) = pending.pop()
+            a = self.find(a)
+            b = self.find(b)
+            if a is b:
+                continue
+            elif isinstance(a, TVar) and isinstance(b, TVar):
+                self.link(a, b)
+            elif isinstance(a, TVar):
+                self.parent[a.s] = b
+            elif isinstance(b, TVar):
+                self.parent[b.s] = a
+            elif isinstance(a, TCon) and isinstance(b, TCon) and (a == b):
+                continue
+            elif isinstance(a, TApp) and isinstance(b, TApp):
+                pending.append((a.b, b.b))
+                pending.append((a.a, b.a))
+            elif isinstance(a, TFun) and isinstance(b, TFun):
+                if len(a.argtys) != len(b.argtys):
+                    raise InferError(a, b)
+                pending.append((a.retty, b.retty))
+                pending.extend(reversed(list(zip(a.argtys, b.argtys))))
+            else:
+                raise InferError(a, b)
+
+    def link(self, a, b):
+        # Union by rank keeps the trees shallow.
+        if a == b:
+            return
+        ra = self.rank.get(a.s, 0)
+        rb = self.rank.get(b.s, 0)
+        if ra < rb:
+            self.parent[a.s] = b
+        elif ra > rb:
+            self.parent[b.s] = a
+        else:
+            self.parent[b.s] = a
+            self.rank[a.s] = ra + 1
+
+    def resolve(self, t, resolved, visiting):
+        t = self.find(t)
+        if isinstance(t, TVar) or isinstance(t, TCon):
+            return t
+        if t in resolved:
+            return resolved[t]
+        if t in visiting:
+            raise TypeError("InfiniteType: {0}".format(t))
+        visiting.add(t)
+        if isinstance(t, TApp):
+            res = TApp(self.resolve(t.a, resolved, visiting),
+                       self.resolve(t.b, resolved, visiting))
+        else:
+            res = TFun([self.resolve(a, resolved, visiting) for a in t.argtys],
+                       self.resolve(t.retty, resolved, visiting))
+        visiting.discard(t)
+        resolved[t] = res
+        return res
+
+    def substitution(self):
+        """
+        The most general unifier found so far, as a substitution from each
+        bound variable name to its fully resolved type.
+        """
+        resolved = {}
+        return dict((s, self.resolve(TVar(s), resolved, set()))
+                    for s in self.parent)
 
 
 def unify(x, y):
-    if isinstance(x, TApp) and isinstance(y, TApp):
-        s1 = unify(x.a, y.a)
-        s2 = unify(apply(s1, x.b), apply(s1, y.b))
-        return compose(s2, s1)
-    elif isinstance(x, TCon) and isinstance(y, TCon) and (x == y):
-        return empty()
-    elif isinstance(x, TFun) and isinstance(y, TFun):
-        if len(x.argtys) != len(y.argtys):
-            return Exception("Wrong number of arguments")
-        s1 = solve(zip(x.argtys, y.argtys))
-        s2 = unify(apply(s1, x.retty), apply(s1, y.retty))
-        return compose(s2, s1)
-    elif isinstance(x, TVar):
-        return bind(x.s, y)
-    elif isinstance(y, TVar):
-        return bind(y.s, x)
-    else:
-        raise InferError(x, y)
+    unifier = Unifier()
+    unifier.unify(x, y)
+    return unifier.substitution()
 
 
 def solve(xs):
-    mgu = empty()
-    cs = deque(xs)
-    while len(cs):
-        (a, b) = cs.pop()
-        s = unify(a, b)
-        mgu = compose(s, mgu)
-        cs = deque(applyList(s, cs))
-    return mgu
-
-
-def bind(n, x):
-    if x == n:
-        return empty()
-    elif occurs_check(n, x):
-        raise TypeError("InfiniteType: {0} {1}".format(n, x))
-    else:
-        return dict([(n, x)])
-
-
-def occurs_check(n, x):
-    return n in ftv(x)
+    unifier = Unifier()
+    for (a, b) in xs:
+        unifier.unify(a, b)
+    return unifier.substitution()
 
 
 def union(s1, s2):
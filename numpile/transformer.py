@@ -1,12 +1,16 @@
+import ast
 import ctypes
-import numpy as np
+import hashlib
 import string
-# import llvmlite.llvmpy.core as ll_core
+import time
+import llvmlite.llvmpy.core as ll_core
 
-from numpile import engine, create_execution_engine
-from numpile.lang import TVar, TFun
-from numpile.pytypes import array, int32, int64, int_type, double_type, \
-    float_type, void_type, pointer, struct_type
+from numpile import engine, engine_lock, object_cache, target, create_execution_engine, \
+    host_engine
+from numpile.lang import TVar, TFun, Var, App, Prim, Index, Store, LitInt, ftv, is_array
+from numpile.solve import apply
+from numpile.pytypes import array, boolean, int64, void, int_type, intp_type, double_type, \
+    float_type, bool_type, void_type, void_ptr, struct_type, pyobject_ptr, status_ptr, to_lltype
 
 
 def naming():
@@ -18,26 +22,145 @@ def naming():
 
 
 def mangler(fname, sig):
-    return fname + str(abs(hash(tuple(sig))))
+    # Must be stable across processes, the symbol name ends up in cached objects.
+    digest = hashlib.sha1(','.join(map(str, sig)).encode('utf-8')).hexdigest()
+    return fname + str(int(digest[:16], 16))
 
 
-_nptypemap = {
-    'i': ctypes.c_int,
-    'f': ctypes.c_float,
-    'd': ctypes.c_double,
+def variant_name(fname, noalias):
+    # The conservative build of a kernel, for overlapping arrays, lives next
+    # to the regular one under its own symbol.
+    return fname if noalias else fname + '_aliased'
+
+
+def entry_name(symbol, argtys):
+    # Kernels taking arrays get a Python entry of their own next to them.
+    return symbol + '_py' if any(map(is_array, argtys)) else symbol
+
+
+# Status words of kernels that failed, and what they raise in Python.
+ZERO_DIVISION = 1
+FLOAT_ZERO_DIVISION = 2
+FLOAT_FLOOR_ZERO_DIVISION = 3
+status_errors = {
+    ZERO_DIVISION: (ZeroDivisionError, "integer division or modulo by zero"),
+    FLOAT_ZERO_DIVISION: (ZeroDivisionError, "float division by zero"),
+    FLOAT_FLOOR_ZERO_DIVISION: (ZeroDivisionError, "float floor division by zero"),
 }
 
 
-def wrap_module(sig, llfunc):
-    pfunc = wrap_function(llfunc, engine)
-    dispatch = dispatcher(pfunc)
+def may_fail(fun, functions=None):
+    """
+    Whether ``fun`` can fail at run time, on a division by zero, itself or in one of the kernels in ``functions`` it calls.
+    """
+    functions = functions or {}
+    for node in ast.walk(fun):
+        if isinstance(node, Prim) and node.fn in ("div#", "floordiv#"):
+            return True
+        if isinstance(node, App) and getattr(node.fn, 'id', None) in functions \
+                and functions[node.fn.id].checked:
+            return True
+    return False
+
+
+def trailing_args(parallel=False, checked=False):
+    # LLVM arguments after a kernel's own: the chunk index and count of a
+    # prange kernel, then the status pointer of one that can fail.
+    return ([intp_type, intp_type] if parallel else []) + ([status_ptr] if checked else [])
+
+
+def array_ranks(fun, functions=None):
+    """
+    The number of dimensions ``fun`` indexes of each of its arguments, as
+    ``a[i, j]`` or ``a.shape[k]`` or through the kernels in ``functions``
+    it passes them to, in order. Zero for scalars.
+    """
+    functions = functions or {}
+    ranks = dict((arg.id, 0) for arg in fun.args)
+    for node in ast.walk(fun):
+        if isinstance(node, Index) and isinstance(node.val, Prim) and node.val.fn == "shape#":
+            if not isinstance(node.ix[0], LitInt):
+                raise NotImplementedError("shape must be indexed with a constant")
+            uses = [(node.val.args[0], node.ix[0].n + 1)]
+        elif isinstance(node, Index):
+            uses = [(node.val, len(node.ix))]
+        elif isinstance(node, Store):
+            uses = [(node.ref, len(node.ix))]
+        elif isinstance(node, App) and getattr(node.fn, 'id', None) in functions:
+            uses = list(zip(node.args, functions[node.fn.id].ranks))
+        else:
+            continue
+        for (ref, rank) in uses:
+            if isinstance(ref, Var) and ref.id in ranks:
+                ranks[ref.id] = max(ranks[ref.id], rank)
+    return [ranks[arg.id] for arg in fun.args]
+
+
+def wrap_module(sig, llfunc, cache_key=None, ranks=(), checked=False, **options):
+    pfunc = wrap_function(llfunc, engine, cache_key, **options)
+    dispatch = dispatcher(pfunc, sig, ranks, checked)
     return dispatch
 
 
-def compile_ir(engine, llvm_ir):
+def wrap_cached(fname, argtys, retty, cache_key, extra=(), noalias=True, ranks=(),
+                checked=False):
     """
-    Compile the LLVM IR string with the given engine.
-    The compiled module object is returned.
+    Load a specialization straight from the object cache, without running
+    the emitter.
+    """
+    fnty = entry_type(argtys, retty, extra)
+    symbol = entry_name(mangler(variant_name(fname, noalias), argtys), argtys)
+    cfunc = load_cached(cache_key, symbol, fnty)
+    if cfunc is None:
+        return None
+    return dispatcher(cfunc, argtys, ranks, checked)
+
+
+def load_cached(cache_key, symbol, fnty):
+    """
+    Bind ``symbol`` from the object cached under ``cache_key``. The engine
+    only needs an empty module carrying the key to load it.
+    """
+    cfuncs = load_cached_many(cache_key, [(symbol, fnty)])
+    return cfuncs and cfuncs[0]
+
+
+def load_cached_many(cache_key, symbols):
+    """
+    Bind every ``(symbol, fnty)`` of ``symbols`` from the one object cached
+    under ``cache_key``, or return None if any of them is missing.
+    """
+    import llvmlite.binding as llvm
+
+    mod = llvm.parse_assembly("")
+    mod.name = cache_key
+    with engine_lock:
+        start = time.perf_counter()
+        engine.add_module(mod)
+        engine.finalize_object()
+        func_ptrs = [engine.get_function_address(symbol) for (symbol, fnty) in symbols]
+        if not all(func_ptrs):
+            engine.remove_module(mod)
+            return None
+        finalize = time.perf_counter() - start
+        mod.code_size = object_cache.code_size(mod.name)
+    mod.engine = engine
+
+    cfuncs = []
+    for ((symbol, fnty), func_ptr) in zip(symbols, func_ptrs):
+        cfunc = cfunctype(fnty)(func_ptr)
+        cfunc.__name__ = symbol
+        cfunc.timings = {'finalize': finalize}
+        cfunc.module = mod
+        cfuncs.append(cfunc)
+    return cfuncs
+
+
+def compile_ir(engine, llvm_ir, cache_key=None, opt=3, vectorize=True, slp=True,
+               machine=None):
+    """
+    Compile the LLVM IR string with the given engine, whose target machine
+    is ``machine``. The compiled module object is returned.
     """
     # Create a LLVM module object from the IR
     import llvmlite.binding as llvm
@@ -66,49 +189,141 @@ def compile_ir(engine, llvm_ir):
     llvm.initialize_native_asmprinter()  # yes, even this one
 
 
+    machine = machine or target
     mod = llvm.parse_assembly(llvm_ir)
+    # The vectorizers need the real target to cost their transformations.
+    mod.triple = machine.triple
+    mod.data_layout = str(machine.target_data)
     mod.verify()
+    if cache_key is not None:
+        # The object cache hooks identify modules by name.
+        mod.name = cache_key
 
-    # Optionally, could use passManagerBuilder to reuse the same options across JIT.
+    mod.timings = {'passes': optimize_module(mod, opt, vectorize, slp, machine=machine)}
+
+    # Now add the module and make sure it is ready for execution
+    with engine_lock:
+        start = time.perf_counter()
+        engine.add_module(mod)
+        engine.finalize_object()
+        engine.run_static_constructors()
+        mod.timings['finalize'] = time.perf_counter() - start
+        mod.code_size = object_cache.code_size(mod.name)
+    mod.engine = engine
+    return mod
+
+def optimize_module(mod, opt=3, vectorize=True, slp=True, promote=True, machine=None):
+    """
+    Run the module and function pass pipelines for the given optimization
+    level over ``mod`` in place, costed for ``machine``. Returns the time
+    spent in seconds. Unless ``promote`` is False locals are promoted to
+    registers first, even at O0.
+    """
+    import llvmlite.binding as llvm
+
+    start = time.perf_counter()
+
+    builder = llvm.create_pass_manager_builder()
+    builder.opt_level = opt
+    builder.loop_vectorize = vectorize
+    builder.slp_vectorize = slp
+    if opt > 0:
+        # Without a threshold the builder adds no inliner at all.
+        builder.inlining_threshold = 275 if opt == 3 else 225
+
+    modPass = llvm.create_module_pass_manager()
     funcPass = llvm.create_function_pass_manager(module = mod)
+    machine = machine or target
+    machine.add_analysis_passes(modPass)
+    machine.add_analysis_passes(funcPass)
+    if promote:
+        # The O0 pipeline has no SROA of its own, every local would stay a
+        # load and a store on the stack.
+        funcPass.add_sroa_pass()
+    builder.populate(modPass)
+    builder.populate(funcPass)
+
     funcPass.initialize()
+    for fn in mod.functions:
+        funcPass.run(fn)
+    funcPass.finalize()
+    modPass.run(mod)
 
-    funcPass.add_dead_arg_elimination_pass()
-    funcPass.add_dead_code_elimination_pass()
+    return time.perf_counter() - start
 
-    passManager = llvm.create_pass_manager_builder()
-    passManager.opt_level = 3
-    passManager.loop_vectorize = True
-    passManager.slp_vectorize = False
 
-    funcPass.finalize()
+def wrap_function(func, engine, cache_key=None, **options):
+    return wrap_functions([func], engine, cache_key, **options)[0]
 
-    # Now add the module and make sure it is ready for execution
-    engine.add_module(mod)
-    engine.finalize_object()
-    engine.run_static_constructors()
-    return mod
 
-def wrap_function(func, engine):
-    args = func.type.pointee.args
-    ret_type = func.type.pointee.return_type
-    ret_ctype = wrap_type(ret_type)
-    args_ctypes = list(map(wrap_type, args))
+def wrap_functions(funcs, engine, cache_key=None, host=False, **options):
+    """
+    Compile the module that all of ``funcs`` belong to, parsing, optimizing
+    and finalizing it once, and return a ctypes function for each. With
+    ``host`` the code is built for this exact CPU, by ``host_engine``.
+    """
+    machine = None
+    if host:
+        engine, machine = host_engine()
+    mod = compile_ir(engine, str(funcs[0].module), cache_key, machine=machine, **options)
+
+    # Look up the function pointers (Python ints)
+    with engine_lock:
+        func_ptrs = [engine.get_function_address(func.name) for func in funcs]
+
+    # Run the functions via ctypes
+    cfuncs = []
+    for (func, func_ptr) in zip(funcs, func_ptrs):
+        cfunc = cfunctype(func.type.pointee)(func_ptr)
+        cfunc.__name__ = func.name
+        cfunc.timings = mod.timings
+        cfunc.module = mod
+        cfuncs.append(cfunc)
+    return cfuncs
+
+
+def function_type(argtys, retty, extra=(), ranks=()):
+    # ``extra`` are trailing LLVM argument types with no Python counterpart.
+    # Arrays are flattened to their data pointer and ``rank`` extents and
+    # strides, so kernels are plain C functions.
+    argtypes = []
+    for (argty, rank) in zip(argtys, ranks or [0] * len(argtys)):
+        argtypes.append(to_lltype(argty))
+        if is_array(argty):
+            argtypes += [intp_type] * (2 * rank)
+    return ll_core.Type.function(to_lltype(retty), argtypes + list(extra), False)
+
+
+def entry_type(argtys, retty, extra=()):
+    # The Python entry of a kernel takes its arrays as ndarray objects.
+    argtypes = [pyobject_ptr if is_array(argty) else to_lltype(argty) for argty in argtys]
+    return ll_core.Type.function(to_lltype(retty), argtypes + list(extra), False)
+
+
+def driver_type(argtys, retty, checked=False):
+    # A driver takes the number of argument sets, then one array per
+    # argument of the entry holding its value in every set, then an array
+    # for the results, then the status pointer if the kernel can fail.
+    argtypes = [intp_type] + [ll_core.Type.pointer(ty) for ty in entry_type(argtys, retty).args]
+    if retty != void:
+        argtypes.append(ll_core.Type.pointer(to_lltype(retty)))
+    return ll_core.Type.function(void_type, argtypes + trailing_args(checked=checked), False)
+
 
-    mod = compile_ir(engine, str(func))
+def cfunctype(fnty):
+    ret_ctype = wrap_type(fnty.return_type)
+    args_ctypes = list(map(wrap_type, fnty.args))
+    return ctypes.CFUNCTYPE(ret_ctype, *args_ctypes)
 
-    # Look up the function pointer (a Python int)
-    func_ptr = engine.get_function_address(func.name)
 
-    # Run the function via ctypes
-    cfunc = ctypes.CFUNCTYPE(ret_ctype, *args_ctypes)(func_ptr)
-    cfunc.__name__ = func.name
-    return cfunc
+_structs = {}
 
 
 def wrap_type(llvm_type):
     kind = type(llvm_type)
-    if kind == type(int_type):
+    if llvm_type == bool_type:
+        ctype = ctypes.c_bool
+    elif kind == type(int_type):
         ctype = getattr(ctypes, "c_int"+str(llvm_type.width))
     elif kind == type(double_type):
         ctype = ctypes.c_double
@@ -116,80 +331,140 @@ def wrap_type(llvm_type):
         ctype = ctypes.c_float
     elif kind == type(void_type):
         ctype = None
-    elif kind == type(pointer):
+    elif kind == type(void_ptr):
         pointee = llvm_type.pointee
-        p_kind = pointee.kind
-        if p_kind == int_type:
-            width = pointee.width
-            if width == 8:
-                ctype = ctypes.c_char_p
-            else:
-                ctype = ctypes.POINTER(wrap_type(pointee))
-        elif p_kind == void_type:
+        if llvm_type == pyobject_ptr:
+            ctype = ctypes.py_object
+        elif pointee == void_ptr.pointee:
             ctype = ctypes.c_void_p
         else:
             ctype = ctypes.POINTER(wrap_type(pointee))
     elif kind == type(struct_type):
-        struct_name = llvm_type.name.split('.')[-1]
-        struct_name = struct_name.encode('ascii')
-        struct_type = None
+        ctype = _structs.get(str(llvm_type))
+        if ctype is None:
+            names = ["field"+str(n) for n in range(len(llvm_type.elements))]
+            fields = [(name, wrap_type(elem))
+                      for name, elem in zip(names, llvm_type.elements)]
+            ctype = _structs[str(llvm_type)] = type(ctypes.Structure)(
+                'struct', (ctypes.Structure,), {'__module__': "numpile", '_fields_': fields})
+    else:
+        raise Exception("Unknown LLVM type %s" % kind)
+    return ctype
 
-        if struct_type and issubclass(struct_type, ctypes.Structure):
-            return struct_type
 
-        if hasattr(struct_type, '_fields_'):
-            names = struct_type._fields_
-        else:
-            names = ["field"+str(n) for n in range(llvm_type.element_count)]
+def dispatcher(fn, argtys=(), ranks=(), checked=False):
+    """
+    The Python callable for the entry ``fn`` of a kernel taking ``argtys``.
+    Arrays go through as they are, the entry reads their data pointer and
+    the first ``ranks`` extents and strides itself; only what it assumes
+    of them is checked here. A ``checked`` entry reports failures through
+    its status pointer, they are raised.
+    """
+    if checked:
+        fn = checked_call(fn)
+    arrays = array_args(argtys, ranks)
+    if not arrays:
+        return fn
 
-        ctype = type(ctypes.Structure)(struct_name, (ctypes.Structure,),
-                                       {'__module__': "numpile"})
+    def _call_closure(*args):
+        for (k, rank) in arrays:
+            arg = args[k]
+            if arg.ndim < rank or not arg.flags.aligned:
+                check_array(arg, rank)
+        return fn(*args)
+    _call_closure.__name__ = fn.__name__
+    _call_closure.timings = getattr(fn, 'timings', {})
+    _call_closure.module = getattr(fn, 'module', None)
+    return _call_closure
 
-        fields = [(name, wrap_type(elem))
-                  for name, elem in zip(names, llvm_type.elements)]
-        setattr(ctype, '_fields_', fields)
-    else:
-        raise Exception("Unknown LLVM type %s" % kind)
-    return ctype
 
+def checked_call(fn):
+    # Call ``fn`` with a status word as its last argument and raise the
+    # error it reports, if any.
+    def _checked_call(*args):
+        status = ctypes.c_int32(0)
+        result = fn(*(args + (ctypes.byref(status),)))
+        if status.value:
+            raise_status(status.value)
+        return result
+    _checked_call.__name__ = fn.__name__
+    _checked_call.timings = getattr(fn, 'timings', {})
+    _checked_call.module = getattr(fn, 'module', None)
+    return _checked_call
 
-def wrap_ndarray(na):
-    # For NumPy arrays grab the underlying data pointer. Doesn't copy.
-    ctype = _nptypemap[na.dtype.char]
-    _shape = list(na.shape)
-    data = na.ctypes.data_as(ctypes.POINTER(ctype))
-    dims = len(na.strides)
-    shape = (ctypes.c_int * dims)(*_shape)
-    return data, dims, shape
 
+def raise_status(status):
+    (error, message) = status_errors[status]
+    raise error(message)
 
-def wrap_arg(arg, val):
-    if isinstance(val, np.ndarray):
-        ndarray = arg._type_
-        data, dims, shape = wrap_ndarray(val)
-        return ndarray(data, dims, shape)
-    else:
-        return val
 
+def batch_dispatcher(fn, argtys, retty, ranks=(), checked=False):
+    """
+    The Python callable for a driver ``fn`` of a kernel taking ``argtys``.
+    It takes a list of argument tuples and returns the list of results,
+    packing every argument into one ctypes array for a single native call.
+    """
+    arrays = array_args(argtys, ranks)
+    columns = [ctypes.py_object if is_array(argty) else wrap_type(to_lltype(argty))
+               for argty in argtys]
+    result = None if retty == void else wrap_type(to_lltype(retty))
+
+    def _batch_call(sets):
+        n = len(sets)
+        for args in sets:
+            for (k, rank) in arrays:
+                arg = args[k]
+                if arg.ndim < rank or not arg.flags.aligned:
+                    check_array(arg, rank)
+        cargs = [(ctype * n)(*column) for (ctype, column) in zip(columns, zip(*sets))]
+        out = None if result is None else (result * n)()
+        if out is not None:
+            cargs.append(out)
+        if checked:
+            status = ctypes.c_int32(0)
+            fn(n, *(cargs + [ctypes.byref(status)]))
+            if status.value:
+                raise_status(status.value)
+        else:
+            fn(n, *cargs)
+        return [None] * n if out is None else list(out)
+    _batch_call.__name__ = fn.__name__
+    _batch_call.timings = getattr(fn, 'timings', {})
+    _batch_call.module = getattr(fn, 'module', None)
+    return _batch_call
+
+
+def array_args(argtys, ranks):
+    # Positions and ranks of the array arguments.
+    return [(k, rank) for (k, (argty, rank)) in enumerate(zip(argtys, ranks))
+            if is_array(argty)]
 
-def dispatcher(fn):
-    def _call_closure(*args):
-        cargs = list(fn._argtypes_)
-        pargs = list(args)
-        rargs = list(map(wrap_arg, cargs, pargs))
-        return fn(*rargs)
-    _call_closure.__name__ = fn.__name__
-    return _call_closure
+
+def check_array(arg, rank):
+    if arg.ndim < rank:
+        raise ValueError("Expected an array of at least %d dimensions, got %d"
+                         % (rank, arg.ndim))
+    if not arg.flags.aligned:
+        raise ValueError("Unaligned arrays are not supported")
+
+
+# Primitives whose operands and result all have one type, and comparisons,
+# whose operands have one type and whose result is a Bool.
+uniform_prims = frozenset(["add#", "sub#", "mult#", "div#", "floordiv#", "neg#", "abs#",
+                           "min#", "max#", "sqrt#", "exp#", "log#", "fma#"])
+compare_prims = frozenset(["lt#", "le#", "gt#", "ge#", "eq#", "ne#"])
 
 
 class TypeInfer(object):
 
-    def __init__(self):
+    def __init__(self, functions=None):
+        self.functions = functions or {}  # Kernels callable by name
         self.constraints = []
         self.env = {}
         self.names = naming()
         self.argtys = None
         self.retty = None
+        self.returns = False
 
     def fresh(self):
         return TVar('$' + next(self.names))  # New meta type variable.
@@ -209,6 +484,9 @@ class TypeInfer(object):
             arg.type = ty
             self.env[arg.id] = ty
         list(map(self.visit, node.body))
+        if not self.returns:
+            # Kernels that only write into their arguments return nothing.
+            self.constraints += [(self.retty, void)]
         return TFun(self.argtys, self.retty)
 
     def visit_Noop(self, node):
@@ -224,6 +502,10 @@ class TypeInfer(object):
         node.type = tv
         return tv
 
+    def visit_LitBool(self, node):
+        node.type = boolean
+        return boolean
+
     def visit_Assign(self, node):
         ty = self.visit(node.val)
         if node.ref in self.env:
@@ -236,42 +518,76 @@ class TypeInfer(object):
     def visit_Index(self, node):
         tv = self.fresh()
         ty = self.visit(node.val)
-        ixty = self.visit(node.ix)
-        self.constraints += [(ty, array(tv)), (ixty, int32)]
+        self.constraints += [(ty, array(tv))]
+        for ix in node.ix:
+            self.constraints += [(self.visit(ix), int64)]
         return tv
 
+    def visit_Store(self, node):
+        ty = self.visit(node.ref)
+        valty = self.visit(node.val)
+        self.constraints += [(ty, array(valty))]
+        for ix in node.ix:
+            self.constraints += [(self.visit(ix), int64)]
+        return None
+
     def visit_Prim(self, node):
         if node.fn == "shape#":
-            return array(int32)
-        elif node.fn == "mult#":
+            return array(int64)
+        elif node.fn in uniform_prims:
+            tys = [self.visit(arg) for arg in node.args]
+            self.constraints += [(tys[0], ty) for ty in tys[1:]]
+            return tys[0]
+        elif node.fn in compare_prims:
             tya = self.visit(node.args[0])
             tyb = self.visit(node.args[1])
             self.constraints += [(tya, tyb)]
-            return tyb
-        elif node.fn == "add#":
-            tya = self.visit(node.args[0])
-            tyb = self.visit(node.args[1])
-            self.constraints += [(tya, tyb)]
-            return tyb
+            return boolean
+        elif node.fn == "select#":
+            tyc = self.visit(node.args[0])
+            tya = self.visit(node.args[1])
+            tyb = self.visit(node.args[2])
+            self.constraints += [(tyc, boolean), (tya, tyb)]
+            return tya
         else:
             raise NotImplementedError
 
+    def visit_App(self, node):
+        callee = self.functions.get(getattr(node.fn, 'id', None))
+        if callee is None:
+            raise NotImplementedError("Only autojit functions defined beforehand can be called")
+        # Each call gets a fresh instance of the callee's type, so it can be
+        # called with different types in one kernel.
+        fty = self.instantiate(callee.infer_ty)
+        argtys = [self.visit(arg) for arg in node.args]
+        retty = self.fresh()
+        node.type = TFun(argtys, retty)
+        self.constraints += [(fty, node.type)]
+        return retty
+
+    def instantiate(self, ty):
+        return apply(dict((v.s, self.fresh()) for v in ftv(ty)), ty)
+
     def visit_Var(self, node):
         ty = self.env[node.id]
         node.type = ty
         return ty
 
     def visit_Return(self, node):
+        self.returns = True
+        if node.val is None:
+            self.constraints += [(self.retty, void)]
+            return
         ty = self.visit(node.val)
         self.constraints += [(ty, self.retty)]
 
     def visit_Loop(self, node):
-        self.env[node.var.id] = int32
+        self.env[node.var.id] = int64
         varty = self.visit(node.var)
         begin = self.visit(node.begin)
         end = self.visit(node.end)
-        self.constraints += [(varty, int32), (
-            begin, int64), (end, int32)]
+        self.constraints += [(varty, int64), (
+            begin, int64), (end, int64)]
         list(map(self.visit, node.body))
 
     def generic_visit(self, node):
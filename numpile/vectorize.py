@@ -0,0 +1,228 @@
+import ctypes
+import time
+
+import numpy as np
+import llvmlite.llvmpy.core as ll_core
+
+from numpile import engine, function_cache, object_cache
+from numpile.autojit import autojit
+from numpile import instrument
+from numpile.instrument import Timer
+from numpile.lang import TFun
+from numpile.pytypes import boolean, int32, int64, float32, double64, bool_type, intp_type, \
+    int_type, void_type, void_ptr, status_ptr
+from numpile.transformer import mangler, load_cached, raise_status, trailing_args, wrap_function
+
+_dtype_pytypes = {
+    np.dtype('int32'): int32,
+    np.dtype('int64'): int64,
+    np.dtype('float32'): float32,
+    np.dtype('double'): double64,
+}
+
+_pytype_dtypes = dict((ty, dtype) for (dtype, ty) in _dtype_pytypes.items())
+# Comparisons give a Bool, stored as a NumPy bool of one byte.
+_pytype_dtypes[boolean] = np.dtype('bool')
+
+
+def loop_type(nargs, checked=False):
+    # Every operand, the output last, is passed as (data, outer stride,
+    # inner stride), followed by the outer and inner trip counts and the
+    # status pointer of a scalar kernel that can fail.
+    return ll_core.Type.function(void_type, [void_ptr, intp_type, intp_type] * (nargs + 1)
+                                 + [intp_type, intp_type] + trailing_args(checked=checked), False)
+
+
+def emit_loop(scalar, name):
+    """
+    Emit a 2-D strided loop next to ``scalar`` that applies it elementwise,
+    ``out[i, j] = scalar(a[i, j], b[i, j], ...)``. Strides are in bytes and
+    may be zero, which is how broadcast operands are passed. The loop stops
+    at the first element the scalar fails on.
+    """
+    scalarty = scalar.type.pointee
+    checked = scalarty.args[-1] == status_ptr if scalarty.args else False
+    nargs = len(scalarty.args) - checked
+    fn = ll_core.Function.new(scalar.module, loop_type(nargs, checked), name)
+    params = list(fn.args)
+    status = params.pop() if checked else None
+    operands = [params[3*k:3*k+3] for k in range(nargs + 1)]
+    n_outer, n_inner = params[-2:]
+
+    entry = fn.append_basic_block("entry")
+    outer_cond = fn.append_basic_block("outer.cond")
+    outer_body = fn.append_basic_block("outer.body")
+    inner_cond = fn.append_basic_block("inner.cond")
+    inner_body = fn.append_basic_block("inner.body")
+    outer_latch = fn.append_basic_block("outer.latch")
+    exit_block = fn.append_basic_block("exit")
+
+    builder = ll_core.Builder(entry)
+    zero = ll_core.Constant.int(intp_type, 0)
+    one = ll_core.Constant.int(intp_type, 1)
+    builder.branch(outer_cond)
+
+    builder.position_at_end(outer_cond)
+    i = builder.phi(intp_type, name='i')
+    builder.cbranch(builder.icmp(ll_core.ICMP_SLT, i, n_outer), outer_body, exit_block)
+
+    builder.position_at_end(outer_body)
+    builder.branch(inner_cond)
+
+    builder.position_at_end(inner_cond)
+    j = builder.phi(intp_type, name='j')
+    builder.cbranch(builder.icmp(ll_core.ICMP_SLT, j, n_inner), inner_body, outer_latch)
+
+    builder.position_at_end(inner_body)
+    # A Bool result is widened to a whole byte, the bits an i1 store leaves
+    # in it are unspecified.
+    retty = ll_core.Type.int(8) if scalarty.return_type == bool_type else scalarty.return_type
+    eltys = list(scalarty.args[:nargs]) + [retty]
+    ptrs = []
+    for ((data, outer, inner), elty) in zip(operands, eltys):
+        offset = builder.add(builder.mul(i, outer), builder.mul(j, inner))
+        ptr = builder.gep(data, [offset])
+        ptrs.append(builder.bitcast(ptr, ll_core.Type.pointer(elty)))
+    vals = [builder.load(ptr) for ptr in ptrs[:-1]]
+    result = builder.call(scalar, vals + ([status] if checked else []))
+    if result.type == bool_type:
+        result = builder.zext(result, retty)
+    builder.store(result, ptrs[-1])
+    j_next = builder.add(j, one)
+    if checked:
+        failed = builder.icmp_signed('!=', builder.load(status), ll_core.Constant.int(int_type, 0))
+        builder.cbranch(failed, exit_block, inner_cond)
+    else:
+        builder.branch(inner_cond)
+
+    builder.position_at_end(outer_latch)
+    i_next = builder.add(i, one)
+    builder.branch(outer_cond)
+
+    builder.position_at_end(exit_block)
+    builder.ret_void()
+
+    i.add_incoming(zero, entry)
+    i.add_incoming(i_next, outer_latch)
+    j.add_incoming(zero, outer_body)
+    j.add_incoming(j_next, inner_body)
+    return fn
+
+
+class Vectorized(object):
+    """
+    A scalar kernel applied elementwise over arrays with NumPy broadcasting.
+    One native loop is compiled per combination of input dtypes.
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.loops = {}
+        self.__name__ = kernel.__name__
+
+    def compile(self, dtypes):
+        types = [_dtype_pytypes[dtype] for dtype in dtypes]
+        symbol = mangler(self.__name__ + '_loop', types)
+        cache_key = self.kernel.cache_key(types, 'vectorize')
+        specializer, retty, argtys = self.kernel.unify(types)
+        if retty not in _pytype_dtypes:
+            raise TypeError("%s must return a number or a comparison, not %s"
+                            % (self.__name__, retty))
+        cfunc = function_cache.get(cache_key, self.evicted)
+        if cfunc is not None:
+            return cfunc, _pytype_dtypes[retty]
+
+        record = {'source': 'disk'}
+        if object_cache.contains(cache_key):
+            cfunc = load_cached(cache_key, symbol, loop_type(len(types), self.kernel.checked))
+        if cfunc is None:
+            record['source'] = 'compiled'
+            with Timer(record)('emit'):
+                scalar, retty, argtys = self.kernel.emit(types)
+                # Only reachable through the loop, so it can be inlined away.
+                scalar.linkage = 'internal'
+                loop = emit_loop(scalar, symbol)
+            cfunc = wrap_function(loop, engine, cache_key, **self.kernel.options)
+        record.update(cfunc.timings, signature=str(TFun(types, retty)))
+        self.kernel.instrument.specialized(self.__name__, record)
+        cfunc.cache_key = cache_key
+        function_cache.put(cache_key, cfunc, cfunc.module, cfunc.module.code_size,
+                           self, self.kernel.max_specializations, self.evicted)
+        return cfunc, _pytype_dtypes[retty]
+
+    def run(self, cfunc, operands, shape):
+        status = ctypes.c_int32(0)
+        extra = [ctypes.byref(status)] if self.kernel.checked else []
+        for index in np.ndindex(*shape[:-2]):
+            slabs = [op[index] for op in operands]
+            cargs = []
+            for slab in slabs:
+                cargs += [slab.ctypes.data, slab.strides[0], slab.strides[1]]
+            cfunc(*(cargs + [shape[-2], shape[-1]] + extra))
+            if status.value:
+                raise_status(status.value)
+
+    def evicted(self, cache_key, cfunc):
+        for (key, entry) in list(self.loops.items()):
+            if entry[0] is cfunc:
+                self.loops.pop(key, None)
+
+    def __call__(self, *args, out=None):
+        arrays = [np.asarray(a) for a in args]
+        dtypes = set(a.dtype for a in arrays)
+        if len(dtypes) > 1:
+            common = np.result_type(*arrays)
+            arrays = [a.astype(common, copy=False) for a in arrays]
+
+        key = tuple(a.dtype for a in arrays)
+        entry = self.loops.get(key)
+        if entry is None:
+            entry = self.loops[key] = self.compile(key)
+        cfunc, out_dtype = entry
+
+        shape = np.broadcast_shapes(*[a.shape for a in arrays])
+        scalar = out is None and len(shape) == 0
+        if out is None:
+            out = np.empty(shape, dtype=out_dtype)
+        elif out.shape != shape or out.dtype != out_dtype:
+            raise ValueError("out must have shape %s and dtype %s, got %s and %s"
+                             % (shape, out_dtype, out.shape, out.dtype))
+        operands = [np.broadcast_to(a, shape) for a in arrays] + [out]
+
+        # The native loop is 2-D; leading dimensions beyond that are walked
+        # here, one native call per 2-D slab.
+        if len(shape) < 2:
+            shape2 = (1,) * (2 - len(shape)) + shape
+            operands = [op.reshape(shape2) if op is out else np.broadcast_to(op, shape2)
+                        for op in operands]
+            shape = shape2
+        start = time.perf_counter() if instrument.enabled else None
+        if self.kernel.max_specializations is not None or function_cache.bounded:
+            # Pinned, an eviction meanwhile can't release the loop mid-call.
+            while True:
+                with function_cache.pinned(cfunc.cache_key) as resident:
+                    if resident:
+                        self.run(cfunc, operands, shape)
+                        break
+                # Evicted since it was looked up, compile it again.
+                entry = self.loops[key] = self.compile(key)
+                cfunc = entry[0]
+        else:
+            self.run(cfunc, operands, shape)
+        if start is not None:
+            self.kernel.instrument.called(key, time.perf_counter() - start)
+
+        if scalar:
+            return out[()]
+        return out
+
+
+def vectorize(fn=None, opt=3, max_specializations=None):
+    """
+    Compile a scalar function into an elementwise loop over arrays,
+    e.g. ``@vectorize def f(a, b): return a * b + a``. Calls broadcast their
+    arguments like a NumPy ufunc and accept a preallocated ``out=``.
+    """
+    if fn is None:
+        return lambda fn: vectorize(fn, opt=opt, max_specializations=max_specializations)
+    return Vectorized(autojit(fn, opt=opt, max_specializations=max_specializations))
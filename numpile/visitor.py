@@ -1,13 +1,22 @@
 import ast
 import inspect
 import types
+from functools import reduce
 from textwrap import dedent
 from numpy import unicode
 
-from numpile.lang import Var, LitFloat, LitInt, LitBool, App, Prim, Assign, Fun, Noop, Return, Index, Loop
-from numpile.pytypes import int32
+from numpile.lang import Var, LitFloat, LitInt, LitBool, App, Prim, Assign, Fun, Noop, Return, Index, Loop, Store
+from numpile.pytypes import int64
 
-primops = {ast.Add: "add#", ast.Mult: "mult#"}
+primops = {ast.Add: "add#", ast.Sub: "sub#", ast.Mult: "mult#", ast.Div: "div#",
+           ast.FloorDiv: "floordiv#"}
+cmpops = {ast.Lt: "lt#", ast.LtE: "le#", ast.Gt: "gt#", ast.GtE: "ge#", ast.Eq: "eq#",
+          ast.NotEq: "ne#"}
+# Functions lowered to primitives, with their number of arguments; min and
+# max take two or more.
+builtins = {"abs": ("abs#", 1), "min": ("min#", None), "max": ("max#", None)}
+math_builtins = {"sqrt": ("sqrt#", 1), "exp": ("exp#", 1), "log": ("log#", 1),
+                 "fma": ("fma#", 3)}
 
 
 class PythonVisitor(ast.NodeVisitor):
@@ -47,15 +56,54 @@ class PythonVisitor(ast.NodeVisitor):
         else:
             return LitInt(node.n)
 
-    def visit_Bool(self, node):
-        return LitBool(node.n)
+    def visit_NameConstant(self, node):
+        if not isinstance(node.value, bool):
+            raise NotImplementedError
+        return LitBool(node.value)
 
     def visit_Call(self, node):
+        builtin = self.builtin(node.func)
+        if builtin is not None:
+            (opname, nargs) = builtin
+            args = list(map(self.visit, node.args))
+            if nargs is None and len(args) >= 2:
+                # min(a, b, c) is min(min(a, b), c)
+                return reduce(lambda a, b: Prim(opname, [a, b]), args)
+            if len(args) != nargs:
+                raise TypeError("%s() got %d arguments" % (opname[:-1], len(args)))
+            return Prim(opname, args)
         name = self.visit(node.func)
         args = list(map(self.visit, node.args))
         keywords = list(map(self.visit, node.keywords))
         return App(name, args)
 
+    def builtin(self, func):
+        # abs, min and max, and math functions called as math.name.
+        if isinstance(func, ast.Name):
+            return builtins.get(func.id)
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) \
+                and func.value.id == "math":
+            return math_builtins.get(func.attr)
+        return None
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.USub):
+            return Prim("neg#", [self.visit(node.operand)])
+        elif isinstance(node.op, ast.UAdd):
+            return self.visit(node.operand)
+        else:
+            raise NotImplementedError
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1:
+            raise NotImplementedError("Chained comparisons are not supported")
+        opname = cmpops[node.ops[0].__class__]
+        return Prim(opname, [self.visit(node.left), self.visit(node.comparators[0])])
+
+    def visit_IfExp(self, node):
+        return Prim("select#", [self.visit(node.test), self.visit(node.body),
+                                self.visit(node.orelse)])
+
     def visit_BinOp(self, node):
         op_str = node.op.__class__
         a = self.visit(node.left)
@@ -67,8 +115,12 @@ class PythonVisitor(ast.NodeVisitor):
         targets = node.targets
 
         assert len(node.targets) == 1
-        var = node.targets[0].id
         val = self.visit(node.value)
+        if isinstance(node.targets[0], ast.Subscript):  # out[i] = ...
+            target = node.targets[0]
+            ref = self.visit(target.value)
+            return Store(ref, self.visit_indices(target.slice), val)
+        var = node.targets[0].id
         return Assign(var, val)
 
     def visit_FunctionDef(self, node):
@@ -81,11 +133,19 @@ class PythonVisitor(ast.NodeVisitor):
     def visit_Pass(self, node):
         return Noop()
 
+    def visit_Expr(self, node):
+        # A call for its effects; a docstring does nothing.
+        if isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            return Noop()
+        return self.visit(node.value)
+
     def visit_Lambda(self, node):
         args = self.visit(node.args)
         body = self.visit(node.body)
 
     def visit_Return(self, node):
+        if node.value is None:
+            return Return(None)
         val = self.visit(node.value)
         return Return(val)
 
@@ -100,33 +160,45 @@ class PythonVisitor(ast.NodeVisitor):
         if isinstance(node.ctx, ast.Load):
             if node.slice:
                 val = self.visit(node.value)
-                ix = self.visit(node.slice.value)
-                return Index(val, ix)
+                return Index(val, self.visit_indices(node.slice))
         elif isinstance(node.ctx, ast.Store):
             raise NotImplementedError
 
+    def visit_indices(self, node):
+        if isinstance(node, ast.Index):  # Python < 3.9
+            node = node.value
+        if isinstance(node, ast.Tuple):  # a[i, j]
+            return list(map(self.visit, node.elts))
+        return [self.visit(node)]
+
     def visit_For(self, node):
         target = self.visit(node.target)
         stmts = list(map(self.visit, node.body))
-        if node.iter.func.id in {"xrange", "range"}:
+        if node.iter.func.id in {"xrange", "range", "prange"}:
             args = list(map(self.visit, node.iter.args))
         else:
             raise Exception("Loop must be over range")
 
+        parallel = node.iter.func.id == "prange"
         if len(args) == 1:   # xrange(n)
-            return Loop(target, LitInt(0, type=int32), args[0], stmts)
+            return Loop(target, LitInt(0, type=int64), args[0], stmts, parallel)
         elif len(args) == 2:  # xrange(n,m)
-            return Loop(target, args[0], args[1], stmts)
+            return Loop(target, args[0], args[1], stmts, parallel)
 
     def visit_AugAssign(self, node):
-        if isinstance(node.op, ast.Add):
-            ref = node.target.id
+        if isinstance(node.target, ast.Subscript):  # out[i] += ...
+            ref = self.visit(node.target.value)
+            ix = self.visit_indices(node.target.slice)
             value = self.visit(node.value)
-            return Assign(ref, Prim("add#", [Var(ref), value]))
-        if isinstance(node.op, ast.Mult):
+            opname = primops[node.op.__class__]
+            # Visit the target again so the load gets its own nodes.
+            current = Index(self.visit(node.target.value),
+                            self.visit_indices(node.target.slice))
+            return Store(ref, ix, Prim(opname, [current, value]))
+        if node.op.__class__ in primops:
             ref = node.target.id
             value = self.visit(node.value)
-            return Assign(ref, Prim("mult#", [Var(ref), value]))
+            return Assign(ref, Prim(primops[node.op.__class__], [Var(ref), value]))
         else:
             raise NotImplementedError
 
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from numpile import autojit, load_library, prange
+from numpile.aot import compile_library
+from numpile.pytypes import array, double64, int64
+
+
+@autojit(signatures=[(int64, int64), (double64, double64)])
+def add(a, b):
+    return a + b
+
+
+@autojit(signatures=[(array(double64),)])
+def tot2(a):
+    s = 0.0
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            s += a[i, j]
+    return s
+
+
+@autojit(signatures=[(array(double64),)])
+def psum(a):
+    c = 0.0
+    for i in prange(a.shape[0]):
+        c += a[i]
+    return c
+
+
+@autojit(signatures=[(array(double64), array(double64))])
+def shift(a, b):
+    for i in range(a.shape[0]):
+        b[i] = a[i] + 1.0
+
+
+@autojit(signatures=[(int64, int64)])
+def fdiv(a, b):
+    return a // b
+
+
+def test_aot_build_load_call(tmp_path):
+    path = str(tmp_path / 'libkern.so')
+    manifest = compile_library([add, tot2], path)
+    assert sorted(e['name'] for e in manifest) == ['add', 'add', 'tot2']
+    lib = load_library(path)
+    assert lib.add(1, 2) == 3
+    assert lib.add(1.5, 2.0) == 3.5
+    a = np.arange(12.0).reshape((3, 4))
+    assert lib.tot2(a) == a.sum()
+    assert lib.tot2(a[:, ::2]) == a[:, ::2].sum()
+
+
+def test_aot_parallel_aliased_and_checked(tmp_path):
+    path = str(tmp_path / 'libmore.so')
+    compile_library([psum, shift, fdiv], path)
+    lib = load_library(path)
+    assert lib.psum(np.arange(1000.0)) == np.arange(1000.0).sum()
+    x = np.zeros(5)
+    lib.shift(x[:-1], x[1:])
+    assert (x == np.arange(5.0)).all()
+    b = np.zeros(3)
+    lib.shift(np.arange(3.0), b)
+    assert (b == np.arange(3.0) + 1.0).all()
+    assert lib.fdiv(-7, 2) == -4
+    with pytest.raises(ZeroDivisionError):
+        lib.fdiv(1, 0)
+    with pytest.raises(TypeError, match="No ahead-of-time specialization"):
+        lib.fdiv(1.0, 2.0)
+
+
+def test_eager_signatures_key_on_rank():
+    a = np.ones((3, 4))
+    assert ((np.ndarray, np.dtype('double'), 2),) in tot2.dispatch
+    assert tot2(a) == 12.0
+    assert len(tot2.dispatch) == 1
@@ -0,0 +1,85 @@
+import threading
+
+import numpy as np
+
+import numpile
+from numpile import autojit, cache, function_cache
+from numpile.cache import FunctionCache
+
+SOURCE = """
+def scaled(a, b):
+    return a * b + 1.0
+"""
+
+
+def sources(kernel):
+    return [s['source'] for s in kernel.stats['specializations']]
+
+
+def drop_resident(kernel):
+    for entry in list(kernel.dispatch.values()):
+        function_cache.discard(getattr(entry, '__wrapped__', entry).cache_key)
+
+
+def test_disk_cache_hits_until_the_compiler_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(numpile.object_cache, 'path', str(tmp_path))
+    first = autojit(SOURCE)
+    assert first(2.0, 3.0) == 7.0
+    assert sources(first) == ['compiled']
+    drop_resident(first)
+
+    second = autojit(SOURCE)
+    assert second(2.0, 3.0) == 7.0
+    assert sources(second) == ['disk']
+    drop_resident(second)
+
+    # Objects built by another version of numpile are never loaded.
+    monkeypatch.setattr(cache, '_compiler_hash', 'another version')
+    third = autojit(SOURCE)
+    assert third(2.0, 3.0) == 7.0
+    assert sources(third) == ['compiled']
+    drop_resident(third)
+
+
+def test_evicted_module_is_released_after_the_calls_running_it():
+    released = []
+    functions = FunctionCache(released.append, max_entries=1)
+    functions.put('a', None, module='module a')
+    with functions.pinned('a') as resident:
+        assert resident
+        functions.put('b', None, module='module b')
+        assert 'a' not in functions
+        assert released == []
+    assert released == ['module a']
+    with functions.pinned('a') as resident:
+        assert not resident
+
+
+def test_eviction_during_a_native_call(monkeypatch):
+    @autojit(max_specializations=1)
+    def total(a):
+        s = a[0] - a[0]
+        for k in range(100):
+            for i in range(a.shape[0]):
+                s += a[i]
+        return s
+
+    running = []
+    release = function_cache.release
+
+    def checked_release(module):
+        running.append(module in function_cache.running)
+        release(module)
+    monkeypatch.setattr(function_cache, 'release', checked_release)
+
+    a = np.ones(200000)
+    results = []
+    worker = threading.Thread(target=lambda: results.extend(total(a) for _ in range(5)))
+    worker.start()
+    # Other dtypes evict the specialization the worker is running.
+    while worker.is_alive():
+        assert total(np.ones(10, dtype=np.int64)) == 1000
+        assert total(np.ones(10, dtype=np.float32)) == 1000.0
+    worker.join()
+    assert results == [100 * 200000.0] * 5
+    assert running and not any(running)
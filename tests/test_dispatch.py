@@ -0,0 +1,31 @@
+import pytest
+
+from numpile import autojit
+from numpile.pytypes import double64
+
+
+@autojit
+def add(a, b):
+    return a + b
+
+
+def test_out_of_range_int_misses_the_cached_entry():
+    assert add(2, 1) == 3
+    for big in (2 ** 64 + 5, 2 ** 63, -2 ** 63 - 1):
+        with pytest.raises(Exception, match="Type not supported"):
+            add(big, 1)
+        with pytest.raises(Exception, match="Type not supported"):
+            add.map([(1, 2), (big, 1)])
+    assert add(2 ** 63 - 1, 0) == 2 ** 63 - 1
+    assert add(-2 ** 63, 0) == -2 ** 63
+
+
+def test_tiered_eager_signatures_start_cold():
+    @autojit(tiered=True, hot_calls=3, signatures=[(double64, double64)])
+    def mul(a, b):
+        return a * b
+
+    assert [s['opt'] for s in mul.stats['specializations']] == [1]
+    for _ in range(5):
+        assert mul(2.0, 3.0) == 6.0
+    assert [(s['opt'], s['host']) for s in mul.stats['specializations']] == [(1, False), (3, True)]
@@ -0,0 +1,39 @@
+import math
+
+import pytest
+
+from numpile import autojit
+
+
+@autojit
+def floordiv(a, b):
+    return a // b
+
+
+@autojit
+def truediv(a, b):
+    return a / b
+
+
+@pytest.mark.parametrize('a, b', [(1.0, 0.1), (-1.0, 0.1), (7.5, -2.0), (-7.5, 2.0),
+                                  (-0.0, 5.0), (0.0, -5.0), (-5.0, float('inf')), (1e308, 1e-308)])
+def test_float_floordiv_matches_python(a, b):
+    result = floordiv(a, b)
+    assert result == a // b
+    assert math.copysign(1.0, result) == math.copysign(1.0, a // b)
+
+
+def test_integer_floordiv_matches_python():
+    for (a, b) in [(7, 2), (-7, 2), (7, -2), (-7, -2), (-2 ** 63, -1)]:
+        assert floordiv(a, b) == ((a // b + 2 ** 63) % 2 ** 64) - 2 ** 63
+
+
+@pytest.mark.parametrize('fn, a, b, message', [
+    (floordiv, 1, 0, "integer division or modulo by zero"),
+    (floordiv, 1.0, 0.0, "float floor division by zero"),
+    (truediv, 1.0, 0.0, "float division by zero"),
+    (truediv, 1.0, -0.0, "float division by zero"),
+])
+def test_division_by_zero_raises(fn, a, b, message):
+    with pytest.raises(ZeroDivisionError, match=message):
+        fn(a, b)
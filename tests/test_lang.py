@@ -0,0 +1,41 @@
+import gc
+import pickle
+
+import pytest
+
+from numpile.lang import TCon, TFun, TVar, Type, ftv
+from numpile.pytypes import array, double64, int64
+
+
+def test_terms_are_interned():
+    assert TCon('Int64') is int64
+    assert TFun([int64, array(double64)], int64) is TFun((int64, array(double64)), int64)
+    assert TFun([int64], int64) is not TFun([int64], double64)
+    assert {array(int64): 1}[array(int64)] == 1
+
+
+def test_terms_are_immutable():
+    with pytest.raises(AttributeError):
+        int64.s = 'Int32'
+    with pytest.raises(AttributeError):
+        TVar('a').x = 1
+
+
+def test_pickled_terms_come_back_interned():
+    ty = TFun([array(double64), TVar('a')], TVar('a'))
+    assert pickle.loads(pickle.dumps(ty)) is ty
+
+
+def test_free_variables():
+    a, b = TVar('a'), TVar('b')
+    assert ftv(TFun([a, array(b)], int64)) == {a, b}
+    assert not ftv(TFun([int64], array(double64)))
+
+
+def test_unused_terms_are_collected():
+    before = len(Type._interned)
+    for k in range(1000):
+        TFun([TVar('unused%d' % k)], array(int64))
+    gc.collect()
+    assert len(Type._interned) < before + 10
+    assert TVar('unused0') is TVar('unused0')
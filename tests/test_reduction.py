@@ -0,0 +1,31 @@
+import numpy as np
+
+from numpile.autojit import arg_pytype, autojit
+
+
+def nested_sum(depth):
+    # s += a[i0, i1, ...] over ``depth`` nested loops.
+    ixs = ['i%d' % k for k in range(depth)]
+    lines = ["def nested(a):", "    s = a[%s] - a[%s]" % ((', '.join(['0'] * depth),) * 2)]
+    for (k, ix) in enumerate(ixs):
+        lines.append("    " * (k + 1) + "for %s in range(a.shape[%d]):" % (ix, k))
+    lines.append("    " * (depth + 1) + "s += a[%s]" % ', '.join(ixs))
+    lines.append("    return s")
+    return "\n".join(lines) + "\n"
+
+
+def ir_lines(kernel, arg):
+    llfunc, _, _ = kernel.emit([arg_pytype(arg)])
+    return len(str(llfunc.module).splitlines())
+
+
+def test_nested_reduction_splits_innermost_loop_only():
+    sizes = []
+    for depth in range(1, 5):
+        a = np.arange(3 ** depth, dtype=np.int64).reshape((3,) * depth)
+        kernel = autojit(nested_sum(depth))
+        assert kernel(a) == a.sum()
+        sizes.append(ir_lines(kernel, a))
+    # Each level adds a loop, not another copy of everything inside it.
+    growth = [b - a for (a, b) in zip(sizes, sizes[1:])]
+    assert max(growth) < sizes[0]
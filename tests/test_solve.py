@@ -0,0 +1,53 @@
+import pytest
+
+from numpile import autojit
+from numpile.lang import TApp, TCon, TFun, TVar
+from numpile.pytypes import array, double64, int64
+from numpile.solve import InferError, apply, solve, unify
+
+
+@autojit
+def add(a, b):
+    return a + b
+
+
+def test_unify_binds_through_shared_variables():
+    a, b = TVar('a'), TVar('b')
+    s = unify(TFun([a, b], a), TFun([int64, TVar('c')], TVar('c')))
+    assert apply(s, TFun([a, b], a)) is TFun([int64, int64], int64)
+
+
+def test_unify_inside_type_applications():
+    s = unify(TApp(TVar('t'), TVar('e')), array(double64))
+    assert apply(s, TVar('e')) is double64
+
+
+@pytest.mark.parametrize('x, y', [
+    (TFun([TVar('a'), TVar('a')], TVar('a')), TFun([int64, double64], TVar('r'))),
+    (TFun([TVar('a')], TVar('a')), TFun([int64, int64], int64)),
+    (array(int64), int64),
+])
+def test_unify_rejects_mismatches(x, y):
+    with pytest.raises(InferError):
+        unify(x, y)
+
+
+def test_unify_rejects_infinite_types():
+    a = TVar('a')
+    with pytest.raises(TypeError, match="InfiniteType"):
+        unify(a, array(a))
+
+
+def test_solve_long_chains():
+    n = 5000
+    constraints = [(TVar('v%d' % k), TVar('v%d' % (k + 1))) for k in range(n)]
+    constraints.append((TVar('v%d' % n), int64))
+    s = solve(constraints)
+    assert all(s['v%d' % k] is int64 for k in range(n))
+
+
+def test_kernel_mixed_signature_fails():
+    assert add(1, 2) == 3
+    assert add(1.0, 2.0) == 3.0
+    with pytest.raises(InferError):
+        add(1, 2.0)
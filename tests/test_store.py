@@ -0,0 +1,60 @@
+import numpy as np
+
+from numpile import autojit
+from numpile.autojit import ALIASED
+
+
+def scale(a, out):
+    for i in range(a.shape[0]):
+        out[i] = a[i] * 2.0
+
+
+def shift(a, b):
+    for i in range(a.shape[0]):
+        b[i] = a[i] + 1.0
+
+
+def transpose(a, out):
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            out[j, i] = a[i, j]
+
+
+def test_store_into_preallocated_output():
+    kernel = autojit(scale)
+    out = np.empty(5)
+    for n in range(3):
+        a = np.arange(5.0) + n
+        assert kernel(a, out) is None
+        assert (out == a * 2.0).all()
+    out = np.zeros(10, dtype=np.float32)
+    kernel(np.arange(5, dtype=np.float32), out[::2])
+    assert (out[::2] == np.arange(5) * 2.0).all()
+    assert not out[1::2].any()
+
+
+def test_store_two_dimensional():
+    kernel = autojit(transpose)
+    a = np.arange(12.0).reshape((3, 4))
+    out = np.empty((4, 3))
+    kernel(a, out)
+    assert (out == a.T).all()
+
+
+def test_overlapping_arguments_keep_python_semantics():
+    kernel = autojit(shift)
+    for (src, dst) in [(slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1))]:
+        expected = np.arange(10.0)
+        shift(expected[src], expected[dst])
+        x = np.arange(10.0)
+        kernel(x[src], x[dst])
+        assert (x == expected).all()
+    assert any(key[-1] == ALIASED for key in kernel.dispatch)
+
+
+def test_disjoint_arguments_use_the_noalias_build():
+    kernel = autojit(shift)
+    x = np.arange(10.0)
+    kernel(x[:5], x[5:])
+    assert (x[5:] == np.arange(5.0) + 1.0).all()
+    assert not any(key[-1] == ALIASED for key in kernel.dispatch)